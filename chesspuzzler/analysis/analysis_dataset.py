@@ -0,0 +1,316 @@
+"""
+Per-ply analysis rows as a partitioned Parquet dataset.
+
+Each analysed game adds its rows (move, side, FEN, cp, wdl, mate,
+evaluation, depth, plus the game id and players) under
+`month=YYYY-MM/` of the dataset directory, with typed columns and the
+judgements dictionary encoded. `read_analysis` and `analysis_batches`
+select by month, game, player or judgement and only read the matching
+partitions, columns and rows, so reports over many games never load the
+whole dataset.
+
+pyarrow is only imported when the dataset is used.
+"""
+
+import glob
+import os
+import time
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import pandas as pd
+from chesspuzzler.analysis.logger import configure_log
+
+logger = configure_log(__name__, "analysis.log")
+
+DATASET_DIR = os.path.join(".", "data", "analysis_dataset")
+
+# rows kept in memory before they are written out as one file
+FLUSH_ROWS = 100_000
+
+COLUMNS = ["game_id", "white", "black", "move_number", "move", "side", "fen", "cp", "wdl", "mate", "evaluation", "depth", "accuracy", "cp_loss"]
+
+
+def schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("game_id", pa.string()),
+        ("white", pa.string()),
+        ("black", pa.string()),
+        ("move_number", pa.int16()),
+        ("move", pa.string()),
+        ("side", pa.dictionary(pa.int8(), pa.string())),
+        ("fen", pa.string()),
+        ("cp", pa.int32()),
+        ("wdl", pa.float32()),
+        ("mate", pa.int16()),
+        ("evaluation", pa.dictionary(pa.int8(), pa.string())),
+        ("depth", pa.int16()),
+        ("accuracy", pa.float32()),
+        ("cp_loss", pa.float32()),
+    ])
+
+
+def game_month(headers: Dict[str, str]) -> str:
+    # lichess dates look like 2023.06.28, unknown parts are question marks
+    date = headers.get("UTCDate") or headers.get("Date") or ""
+    year, _, month = date.partition(".")
+    month = month[:2]
+    if year.isdigit() and month.isdigit():
+        return f"{year}-{month}"
+    return "unknown"
+
+
+def header_game_id(headers: Dict[str, str]) -> str:
+    return headers.get("Site", "").split("/")[-1]
+
+
+def game_rows(data: pd.DataFrame, headers: Dict[str, str]) -> pd.DataFrame:
+    """The report of one game, as returned by `GameAnalysis`, in dataset columns."""
+    rows = data.copy()
+    rows["game_id"] = header_game_id(headers)
+    rows["white"] = headers.get("White", "?")
+    rows["black"] = headers.get("Black", "?")
+    rows["move"] = rows["move"].map(str)
+    for column in ["depth", "accuracy", "cp_loss"]:
+        if column not in rows:
+            rows[column] = None
+    return rows[COLUMNS]
+
+
+class AnalysisDataset:
+    """
+    Appends game reports to the dataset at `root`. Rows are buffered per
+    month and written as one file per month on `flush`, which happens
+    every `flush_rows` rows and on `close`. Files are written under a
+    hidden name and renamed, so readers never see a partial file. Batch
+    runs should keep one dataset open for all their games, and `compact`
+    the `months` they wrote to once done.
+    """
+
+    def __init__(self, root: str = DATASET_DIR, flush_rows: int = FLUSH_ROWS) -> None:
+        self.root = root
+        self.flush_rows = flush_rows
+        self.pending: Dict[str, List[pd.DataFrame]] = {}
+        self.pending_rows = 0
+        self.pending_games: Dict[str, Set[str]] = {}
+        # ids of the games whose rows already on disk are dropped on the next flush, per month
+        self.replaced: Dict[str, Set[str]] = {}
+        self.months: Set[str] = set()
+
+    def append(self, data: pd.DataFrame, headers: Dict[str, str]) -> None:
+        rows = game_rows(data, headers)
+        month = game_month(headers)
+        self.pending.setdefault(month, []).append(rows)
+        self.pending_games.setdefault(month, set()).add(header_game_id(headers))
+        self.pending_rows += len(rows)
+        if self.pending_rows >= self.flush_rows:
+            self.flush()
+
+    def replace(self, data: pd.DataFrame, headers: Dict[str, str]) -> None:
+        """Appends the report of a game in place of the rows it already has."""
+        game_id, month = header_game_id(headers), game_month(headers)
+        if game_id in self.pending_games.get(month, ()):
+            # a report of the game is still buffered, it goes as well
+            frames = [kept for kept in (frame[frame["game_id"] != game_id] for frame in self.pending[month]) if len(kept)]
+            self.pending_rows -= sum(map(len, self.pending[month])) - sum(map(len, frames))
+            self.pending[month] = frames
+        self.replaced.setdefault(month, set()).add(game_id)
+        self.append(data, headers)
+
+    def flush(self) -> None:
+        if not self.pending and not self.replaced:
+            return
+        import pyarrow as pa
+        for month in set(self.pending) | set(self.replaced):
+            # files from before the new rows, which are the only ones replaced rows can be in
+            existing = partition_files(self.root, month)
+            if self.pending.get(month):
+                table = pa.Table.from_pandas(pd.concat(self.pending[month], ignore_index = True), schema = schema(), preserve_index = False)
+                path = write_partition(self.root, month, table)
+                logger.debug(f"Wrote {table.num_rows} analysis rows to {path}")
+            if self.replaced.get(month):
+                drop_games(self.root, month, existing, self.replaced[month])
+            self.months.add(month)
+        self.pending = {}
+        self.pending_rows = 0
+        self.pending_games = {}
+        self.replaced = {}
+
+    def close(self) -> None:
+        self.flush()
+
+    def compact(self) -> int:
+        """Compacts the months written to so far, see `compact`."""
+        return sum(compact(self.root, month) for month in sorted(self.months))
+
+    def __enter__(self) -> "AnalysisDataset":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def partition_dir(root: str, month: str) -> str:
+    return os.path.join(root, f"month={month}")
+
+
+def partition_files(root: str, month: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(partition_dir(root, month), "part-*.parquet")))
+
+
+def write_partition(root: str, month: str, table) -> str:
+    import pyarrow.parquet as pq
+    directory = partition_dir(root, month)
+    os.makedirs(directory, exist_ok = True)
+    name = f"part-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+    path = os.path.join(directory, name)
+    # files starting with a dot are ignored by readers until renamed
+    pq.write_table(table, os.path.join(directory, "." + name), compression = "zstd")
+    os.replace(os.path.join(directory, "." + name), path)
+    return path
+
+
+def append_game(data: pd.DataFrame, headers: Dict[str, str], root: str = DATASET_DIR) -> None:
+    """Writes the report of a single game straight away."""
+    with AnalysisDataset(root) as dataset:
+        dataset.append(data, headers)
+
+
+def replace_game(data: pd.DataFrame, headers: Dict[str, str], root: str = DATASET_DIR) -> None:
+    """Writes the report of a single game in place of the rows it already has, straight away."""
+    with AnalysisDataset(root) as dataset:
+        dataset.replace(data, headers)
+
+
+def drop_games(root: str, month: str, paths: List[str], game_ids: Set[str]) -> None:
+    """Rewrites the files among `paths` holding rows of `game_ids` without them."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    ids = pa.array(sorted(game_ids), pa.string())
+    for path in paths:
+        # only the id column is read to find the files to rewrite
+        if not pc.any(pc.is_in(pq.read_table(path, columns = ["game_id"]).column("game_id"), value_set = ids)).as_py():
+            continue
+        table = pq.read_table(path, schema = schema())
+        rest = table.filter(pc.invert(pc.is_in(table.column("game_id"), value_set = ids)))
+        # the rest is written before the old file goes, a crash leaves duplicates rather than gaps
+        if rest.num_rows:
+            write_partition(root, month, rest)
+        os.remove(path)
+
+
+def dataset_filter(
+    game_ids: Optional[Iterable[str]] = None,
+    players: Optional[Iterable[str]] = None,
+    evaluations: Optional[Iterable[str]] = None,
+    months: Optional[Iterable[str]] = None,
+):
+    import pyarrow.dataset as ds
+    conditions = []
+    if months is not None:
+        conditions.append(ds.field("month").isin(list(months)))
+    if game_ids is not None:
+        conditions.append(ds.field("game_id").isin(list(game_ids)))
+    if players is not None:
+        players = list(players)
+        conditions.append(ds.field("white").isin(players) | ds.field("black").isin(players))
+    if evaluations is not None:
+        # Judgement members or their values
+        values = [getattr(evaluation, "value", evaluation) for evaluation in evaluations]
+        conditions.append(ds.field("evaluation").isin(values))
+    condition = None
+    for expression in conditions:
+        condition = expression if condition is None else condition & expression
+    return condition
+
+
+def open_dataset(root: str = DATASET_DIR):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    # files written before a column was added read it as nulls
+    full_schema = schema().append(pa.field("month", pa.string()))
+    return ds.dataset(root, schema = full_schema, format = "parquet", partitioning = "hive")
+
+
+def analysis_batches(
+    root: str = DATASET_DIR,
+    game_ids: Optional[Iterable[str]] = None,
+    players: Optional[Iterable[str]] = None,
+    evaluations: Optional[Iterable[str]] = None,
+    months: Optional[Iterable[str]] = None,
+    columns: Optional[List[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    """Yields the matching rows a record batch at a time."""
+    if not os.path.isdir(root):
+        return
+    condition = dataset_filter(game_ids, players, evaluations, months)
+    for batch in open_dataset(root).to_batches(columns = columns, filter = condition):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+def read_analysis(
+    root: str = DATASET_DIR,
+    game_ids: Optional[Iterable[str]] = None,
+    players: Optional[Iterable[str]] = None,
+    evaluations: Optional[Iterable[str]] = None,
+    months: Optional[Iterable[str]] = None,
+    columns: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """
+    The rows of the games, players (either side) and judgements asked
+    for, all rows when nothing is. Judgements and sides come back as
+    categoricals.
+    """
+    if not os.path.isdir(root):
+        return pd.DataFrame(columns = columns or COLUMNS)
+    condition = dataset_filter(game_ids, players, evaluations, months)
+    return open_dataset(root).to_table(columns = columns, filter = condition).to_pandas()
+
+
+def game_evals(game_id: str, root: str = DATASET_DIR) -> Dict[int, Tuple[Optional[int], Optional[int], Optional[int]]]:
+    """
+    `(cp, mate, depth)` of each ply of a game, from the mover's point of
+    view as in the report, keeping the deepest when a ply is there twice.
+    """
+    evals: Dict[int, Tuple[Optional[int], Optional[int], Optional[int]]] = {}
+    rows = read_analysis(root, game_ids = [game_id], columns = ["move_number", "cp", "mate", "depth"])
+    for ply, cp, mate, depth in rows.itertuples(index = False):
+        cp, mate, depth = [None if pd.isna(value) else int(value) for value in (cp, mate, depth)]
+        if ply not in evals or (depth or 0) >= (evals[ply][2] or 0):
+            evals[int(ply)] = (cp, mate, depth)
+    return evals
+
+
+def games_below_depth(depth: int, root: str = DATASET_DIR) -> List[str]:
+    """Ids of the games with a ply analysed shallower than `depth`."""
+    import pyarrow.dataset as ds
+    if not os.path.isdir(root):
+        return []
+    shallow = (ds.field("depth") < depth) | ds.field("depth").is_null()
+    table = open_dataset(root).to_table(columns = ["game_id"], filter = shallow)
+    return sorted(set(table.column("game_id").to_pylist()))
+
+
+def compact(root: str = DATASET_DIR, month: Optional[str] = None) -> int:
+    """
+    Rewrites each partition (or just `month`) made of several files as a
+    single file, since every analysed game adds one. Returns how many
+    files were merged away.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    merged = 0
+    directories = [partition_dir(root, month)] if month else sorted(glob.glob(os.path.join(root, "month=*")))
+    for directory in directories:
+        paths = partition_files(root, directory.rsplit("month=", 1)[-1])
+        if len(paths) < 2:
+            continue
+        table = pa.concat_tables([pq.read_table(path, schema = schema()) for path in paths])
+        write_partition(root, directory.rsplit("month=", 1)[-1], table)
+        for path in paths:
+            os.remove(path)
+        merged += len(paths) - 1
+    logger.info(f"Compacted {merged} analysis files in {root}")
+    return merged
@@ -1,6 +1,8 @@
 import chess
 import math
+import numpy as np
 from chess import Board, Square, Move
+from typing import Optional
 import re
 """Board tools."""
 
@@ -62,12 +64,46 @@ def is_piece_hanging(board: Board, square: Square):
 
     return attacked and not defended
 
+WIN_CHANCES_MULTIPLIER = -0.00368208 # https://github.com/lichess-org/lila/pull/11148
+
+def win_chances_array(cp, mate=None) -> np.ndarray:
+    """
+    Winning chances from -1 to 1 of centipawn scores, element-wise.
+    A `mate` that is not NaN wins (> 0) or loses (<= 0) outright, a NaN
+    `cp` without a mate is even.
+    """
+    cp = np.asarray(cp, dtype=np.float64)
+    with np.errstate(over="ignore"):
+        chances = 2 / (1 + np.exp(WIN_CHANCES_MULTIPLIER * cp)) - 1
+    chances = np.where(np.isnan(cp), 0.0, chances)
+    if mate is not None:
+        mate = np.asarray(mate, dtype=np.float64)
+        chances = np.where(np.isnan(mate), chances, np.where(mate > 0, 1.0, -1.0))
+    return chances
+
+def wdl_array(chances) -> np.ndarray:
+    """Winning chances as an expected score from 0 to 1."""
+    return (50 + 50 * np.asarray(chances, dtype=np.float64)) * 0.01
+
+def score_win_chances(cp: Optional[int], mate: Optional[int]) -> float:
+    """
+    `win_chances_array` of one score, as `Score.score()` and `Score.mate()`
+    give it, in plain floats: it runs for every ply.
+    """
+    if mate is not None:
+        return 1.0 if mate > 0 else -1.0
+    if cp is None:
+        return 0.0
+    try:
+        return 2 / (1 + math.exp(WIN_CHANCES_MULTIPLIER * cp)) - 1
+    except OverflowError:
+        return -1.0
+
 def win_chances(cp: int) -> float:
     """
     winning chances from -1 to 1 """
-    MULTIPLIER = -0.00368208 # https://github.com/lichess-org/lila/pull/11148
     cp = cp if cp else 10_000
-    return 2 / (1 + math.exp(MULTIPLIER * cp)) - 1
+    return score_win_chances(cp, None)
 
 def wdl_score(winningChance):
     return (50 + 50 * winningChance) * 0.01
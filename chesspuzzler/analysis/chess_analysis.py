@@ -10,6 +10,7 @@ from enum import Enum
 from typing import Optional
 import pandas as pd
 from chesspuzzler.analysis.file_util import FileManager
+from chesspuzzler.analysis.analysis_dataset import AnalysisDataset
 import chess
 from chess import Board, Square, Move
 import chess.pgn
@@ -24,6 +25,7 @@ from chesspuzzler.analysis.board_util import (
 from chesspuzzler.analysis.model import CandidateMoves, EngineMove, TrackEval
 from colorama import Fore, Back, Style
 from chesspuzzler.analysis.model import TrackEval, BoardInfo
+from chesspuzzler.analysis.metrics import ply_metrics, game_metrics
 from chesspuzzler.analysis.logger import configure_log
 
 # Create logging folder if it does not exist
@@ -44,6 +46,14 @@ class Judgement(Enum):
     FORCED = "Forced"
     
 
+# NAGs for the judgements of bad moves
+JUDGEMENT_NAGS = {
+    Judgement.BLUNDER.value: chess.pgn.NAG_BLUNDER,
+    Judgement.MISTAKE.value: chess.pgn.NAG_MISTAKE,
+    Judgement.INACCURACY.value: chess.pgn.NAG_DUBIOUS_MOVE,
+}
+
+
 class EvaluationEngine:
     CandidateInfo: Optional[CandidateMoves] = None
     def __init__(
@@ -56,16 +66,28 @@ class EvaluationEngine:
         turn: int
     ) -> None:
         self.engine = engine
-        self.board = board.copy()
+        # the board of the game being analysed, only read while judging the move
+        self.board = board
         self.move = move
         self.info = info
         self.prevInfo = prevInfo
         self.turn = turn
         self.comment = ""
-        self.best_move = prevInfo["pv"][0].uci()
-        self.initial_board = board.copy()
+        self._best_move: Optional[str] = None
+        # the position before the move, copied without the rest of the move stack
+        self.initial_board = board.copy(stack=1)
         self.initial_board.pop()
 
+    @property
+    def best_move(self) -> str:
+        # read on demand: an eval reused from the PGN only has a pv once searched
+        if self._best_move is None:
+            self._best_move = self.prevInfo["pv"][0].uci()
+        return self._best_move
+
+    @best_move.setter
+    def best_move(self, move: str) -> None:
+        self._best_move = move
        
     def position_classification(self) -> str:
         self.current = TrackEval(self.info["score"], self.turn)
@@ -87,7 +109,7 @@ class EvaluationEngine:
             self.comment = "Game Ended with Checkmate..."
             return Judgement.BEST.value
         
-        if len(list(self.initial_board.legal_moves)) == 1:
+        if self.initial_board.legal_moves.count() == 1:
             self.comment = "Forced move"
             return Judgement.FORCED.value
         
@@ -179,7 +201,7 @@ class EvaluationEngine:
 
         if not EvaluationEngine.CandidateInfo:
             # If `CandidateInfo` is not set (i.e None) and analyse position with higher engine depth
-            EvaluationEngine.CandidateInfo = self.engine.analyse(chess.Board(self.initial_board.fen()), limit=Limit(depth=27), multipv=2)
+            EvaluationEngine.CandidateInfo = self.engine.analyse(self.initial_board.copy(stack=False), limit=Limit(depth=27), multipv=2)
 
         MultiInfo = EvaluationEngine.CandidateInfo
         BestInfo, SecondInfo = MultiInfo[0], MultiInfo[1]
@@ -230,24 +252,69 @@ class EvaluationEngine:
             return Judgement.EXCELLENT.value
         return Judgement.BEST.value
 
+class EmbeddedInfo(dict):
+    """
+    An eval read from a PGN comment, standing in for the engine's
+    `InfoDict` of the position. Comments carry no principal variation,
+    so the position is only searched if `pv` is asked for.
+    """
+
+    def __init__(self, engine: SimpleEngine, board: Board, score: PovScore, depth: int, search_depth: int = Constant.SCAN_ENGINE_DEPTH) -> None:
+        super().__init__(score=score, depth=depth)
+        self.engine = engine
+        self.board = board.copy(stack=False)
+        self.search_depth = search_depth
+
+    def __missing__(self, key):
+        if key != "pv":
+            raise KeyError(key)
+        info = self.engine.analyse(self.board, Limit(depth=self.search_depth))
+        self["pv"] = info["pv"]
+        return self["pv"]
+
+
 class GameAnalysis(FileManager):
 
-    def __init__(self, game) -> None:
+    def __init__(self, game, output: str = Constant.ANALYSIS_OUTPUT, reuse_depth: Optional[int] = None, annotate: bool = False, dataset: Optional[AnalysisDataset] = None) -> None:
         super().__init__()
         self.game = game
+        self.output = output
+        # a batch run's open dataset, rows are buffered there instead of written per game
+        self.dataset = dataset
+        # evals already in the game at or above this depth are used instead of searching
+        self.reuse_depth = reuse_depth
+        # leave evals, NAGs and best moves on the game's nodes
+        self.annotate = annotate
+        self.depth = Constant.SCAN_ENGINE_DEPTH
         self.is_game_processed = False
 
+    def embedded_info(self, engine: SimpleEngine, board: Board, node: ChildNode) -> Optional[EmbeddedInfo]:
+        """The node's own eval, when reusing evals and it is deep enough."""
+        if self.reuse_depth is None:
+            return None
+        score = node.eval()
+        if score is None:
+            return None
+        depth = node.eval_depth() or Constant.UNDEPTHED_EVAL_DEPTH
+        if depth < self.reuse_depth:
+            return None
+        return EmbeddedInfo(engine, board, score, depth, self.depth)
+
+    def search(self, engine: SimpleEngine, board: Board, node: ChildNode) -> InfoDict:
+        return engine.analyse(board, chess.engine.Limit(depth=self.depth), info= chess.engine.Info.ALL)
+
     def game_analysis(self):
         from chesspuzzler.analysis.logger import log_board
         
         board = chess.Board()
         print("Load Engine")
         engine = SimpleEngine.popen_uci(Constant.ENGINE_PATH)
-        prevInfo = engine.analyse(board, chess.engine.Limit(depth=20), info= chess.engine.Info.ALL)
+        prevInfo = engine.analyse(board, chess.engine.Limit(depth=self.depth), info= chess.engine.Info.ALL)
         print("Engine Successfully loaded")
+        searched = reused = 0
 
         game_data = []
-        column_labels = ["move_number", "move", "side", "fen", "cp", "wdl", "mate", "evaluation"]
+        column_labels = ["move_number", "move", "side", "fen", "cp", "wdl", "mate", "evaluation", "depth"]
 
         for node in self.game.mainline():
             if not board.is_legal(node.move):
@@ -257,42 +324,75 @@ class GameAnalysis(FileManager):
                 break
             
             board.push(node.move)
-            board_info = BoardInfo(node)
-            currInfo = engine.analyse(board, chess.engine.Limit(depth=20), info= chess.engine.Info.ALL)
+            board_info = BoardInfo(node, board)
+            currInfo = self.embedded_info(engine, board, node)
+            if currInfo is None:
+                currInfo = self.search(engine, board, node)
+                searched += 1
+            else:
+                reused += 1
 
             evaluate = EvaluationEngine(engine, board, node.move, currInfo, prevInfo, not board.turn)
             position_classification = evaluate.position_classification()
+            if self.annotate:
+                self.annotate_node(node, currInfo, position_classification, evaluate)
     
             # After evaluating the board position update the `prevScore`
             prevInfo = currInfo
 
             cp, wdl, mate = evaluate.current.cp, evaluate.current.wdl, evaluate.current.mate
-            move_info = board_info.get_info() + [cp, wdl, mate, position_classification]
+            move_info = board_info.get_info() + [cp, wdl, mate, position_classification, currInfo.get("depth")]
             board_logger.info(log_board(board_info, node, currInfo["score"].pov(node.turn), position_classification))
             logger.debug("--"*20)
             game_data.append(move_info)
 
 
         df = pd.DataFrame(game_data, columns=column_labels)
+        df = df.join(ply_metrics(df)[["accuracy", "cp_loss"]])
+        summary = game_metrics(df)
+        if reused:
+            print(f"Reused {reused} evals from the game, searched {searched} positions")
         print(df.groupby(["side", "evaluation"])["move_number"].count())
+        print(summary[["accuracy", "acpl"]])
         # self.update_game(node.game(), node.game().headers.get("Site"))
-        self.save_dataframe(df, node.game().headers.get("Site"))  
+        if self.output in ["csv", "both"]:
+            self.save_dataframe(df, node.game().headers.get("Site"))
+            self.save_dataframe(summary, node.game().headers.get("Site"), "_summary")
+        if self.output in ["parquet", "both"]:
+            self.save_dataset(df, node.game().headers)
         engine.quit()
         self.is_game_processed = True 
         return node.game()
     
     @staticmethod
-    def set_node_details(node: ChildNode, povscore: PovScore) -> ChildNode:
+    def annotate_node(node: ChildNode, info: InfoDict, judgement: str, evaluate: EvaluationEngine) -> ChildNode:
+        """
+        Sets node eval and, for a bad move, its NAG and a comment with the best move.
+        """
+        node.set_eval(info["score"], info.get("depth"))
+        # NAGs of an earlier annotation are replaced
+        node.nags.difference_update(JUDGEMENT_NAGS.values())
+        if judgement in JUDGEMENT_NAGS:
+            node.nags.add(JUDGEMENT_NAGS[judgement])
+            best_move = Move.from_uci(evaluate.best_move)
+            best = evaluate.initial_board.san(best_move) if evaluate.initial_board.is_legal(best_move) else evaluate.best_move
+            text = f"{judgement}. Best move was {best}."
+            if text not in node.comment:
+                node.comment = f"{node.comment} {text}".strip()
+        return node
+
+    @staticmethod
+    def set_node_details(node: ChildNode, povscore: PovScore, depth: int = Constant.SCAN_ENGINE_DEPTH) -> ChildNode:
         """
         Sets node comment with evaluation and engine depth.
         """
         if node.eval() and node.eval_depth():
-            if node.eval_depth() < Constant.SCAN_ENGINE_DEPTH:
-                node.set_eval(povscore, Constant.SCAN_ENGINE_DEPTH)
+            if node.eval_depth() < depth:
+                node.set_eval(povscore, depth)
             if node.clock():
                 node.set_clock(node.clock())
         else:
-            node.set_eval(povscore, Constant.SCAN_ENGINE_DEPTH)
+            node.set_eval(povscore, depth)
             if node.clock():
                 node.set_clock(node.clock())
         return node
@@ -9,5 +9,21 @@ class Constant:
     # Game Analysis Scan depth
     SCAN_ENGINE_DEPTH = 20
 
+    # Depth taken for [%eval] comments that do not state one, as in lichess server analysis exports
+    UNDEPTHED_EVAL_DEPTH = 20
+
+    # Where game analysis reports go: "csv" (one file per game), "parquet" (the analysis dataset) or "both"
+    ANALYSIS_OUTPUT = "csv"
+
+    # Local PGN dumps searched for a game id before downloading it
+    PGN_DUMP_DIR = "data/dumps"
+
+    # Games synced by get_lichess_games.py --sync waiting for analysis, and the analysed ones
+    ANALYSIS_QUEUE_PATH = "data/analysis_queue.txt"
+    ANALYSIS_DONE_PATH = "data/analysis_queue.done"
+
+    # Rate limit state shared by every process that talks to lichess
+    LICHESS_RATE_PATH = "data/lichess_rate.state"
+
     # Puzzle Creation Depth
     PUZZLE_ENGINE_DEPTH = 25
\ No newline at end of file
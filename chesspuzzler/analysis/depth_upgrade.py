@@ -0,0 +1,143 @@
+"""
+Re-analysis of games at a greater depth, searching only what changed.
+
+The depth each ply was last searched at comes from the game's own
+`[%eval]` comments and from the analysis dataset. `DepthUpgrade` reuses
+every eval already at the target depth and searches the rest, or only
+`budget` of them, preferring the plies whose judgement is closest to
+changing. The new evals are written back into the stored game and the
+game's report is replaced, so a later upgrade picks up where this one
+stopped.
+"""
+
+import math
+from typing import Dict, Optional, Set, Tuple
+import chess
+from chess import Board
+from chess.engine import Cp, Mate, PovScore, InfoDict, SimpleEngine
+from chess.pgn import ChildNode
+from chesspuzzler.analysis.analysis_dataset import DATASET_DIR, AnalysisDataset, game_evals, replace_game
+from chesspuzzler.analysis.chess_analysis import EmbeddedInfo, GameAnalysis
+from chesspuzzler.analysis.constants import Constant
+from chesspuzzler.analysis.model import TrackEval
+from chesspuzzler.analysis.logger import configure_log
+
+logger = configure_log(__name__, "analysis.log")
+
+# drops in win probability at which EvaluationEngine changes its judgement
+JUDGEMENT_THRESHOLDS = [0.2, 0.1, 0.05, 0.02]
+
+StoredEvals = Dict[int, Tuple[PovScore, int]]
+
+
+def mover(ply: int) -> chess.Color:
+    return chess.WHITE if ply % 2 else chess.BLACK
+
+
+def stored_evals(game, root: str = DATASET_DIR) -> StoredEvals:
+    """The deepest known eval of each ply, from the game's comments and the analysis dataset."""
+    evals: StoredEvals = {}
+    for node in game.mainline():
+        score = node.eval()
+        if score is not None:
+            evals[node.ply()] = (score, node.eval_depth() or Constant.UNDEPTHED_EVAL_DEPTH)
+
+    game_id = game.headers.get("Site", "").split("/")[-1]
+    for ply, (cp, mate, depth) in game_evals(game_id, root).items():
+        # report scores are from the mover's point of view, mate 0 meaning no mate
+        if mate:
+            score = PovScore(Mate(mate), mover(ply))
+        elif cp is not None:
+            score = PovScore(Cp(cp), mover(ply))
+        else:
+            continue
+        if depth is not None and (ply not in evals or depth > evals[ply][1]):
+            evals[ply] = (score, depth)
+    return evals
+
+
+def threshold_distance(evals: StoredEvals, ply: int) -> float:
+    """How close the judgements depending on `ply`'s eval, its own and the next move's, are to changing."""
+    distance = math.inf
+    for judged in (ply, ply + 1):
+        if judged - 1 not in evals or judged not in evals:
+            continue
+        turn = mover(judged)
+        drop = TrackEval(evals[judged - 1][0], turn).wdl - TrackEval(evals[judged][0], turn).wdl
+        distance = min([distance] + [abs(drop - threshold) for threshold in JUDGEMENT_THRESHOLDS])
+    return distance
+
+
+def plan_upgrade(evals: StoredEvals, depth: int, budget: Optional[int] = None, near_threshold: bool = False) -> Set[int]:
+    """
+    Plies whose stored eval is shallower than `depth`, at most `budget`
+    of them: the closest to a judgement threshold first when
+    `near_threshold`, otherwise the earliest.
+    """
+    shallow = sorted(ply for ply, (_, eval_depth) in evals.items() if eval_depth < depth)
+    if budget is None or len(shallow) <= budget:
+        return set(shallow)
+    if near_threshold:
+        shallow.sort(key = lambda ply: threshold_distance(evals, ply))
+    return set(shallow[:budget])
+
+
+class DepthUpgrade(GameAnalysis):
+    """
+    Analyses `game` at `depth`, searching only the plies `plan_upgrade`
+    picks and those without any stored eval. Plies left over by a budget
+    keep their old eval and depth. The game's rows are always replaced in
+    the dataset, which later upgrades read depths from; a CSV `output` is
+    written as well. The game with its new evals is put back into the
+    store unless `store_game` is off, for callers that store it themselves.
+    Given a `dataset`, the rows are replaced there on its next flush and
+    `root` is taken from it.
+    """
+
+    def __init__(
+        self,
+        game,
+        depth: int,
+        output: str = Constant.ANALYSIS_OUTPUT,
+        budget: Optional[int] = None,
+        near_threshold: bool = False,
+        annotate: bool = False,
+        root: str = DATASET_DIR,
+        store_game: bool = True,
+        dataset: Optional[AnalysisDataset] = None,
+    ) -> None:
+        super().__init__(game, "parquet" if output == "parquet" else "both", annotate = annotate, dataset = dataset)
+        self.depth = depth
+        self.root = dataset.root if dataset is not None else root
+        self.store_game = store_game
+        self.evals = stored_evals(game, self.root)
+        self.upgrade = plan_upgrade(self.evals, depth, budget, near_threshold)
+        logger.info(f"Upgrading {len(self.upgrade)} of {len(self.evals)} stored evals to depth {depth}")
+
+    def embedded_info(self, engine: SimpleEngine, board: Board, node: ChildNode) -> Optional[EmbeddedInfo]:
+        ply = node.ply()
+        if ply in self.upgrade or ply not in self.evals:
+            return None
+        score, depth = self.evals[ply]
+        return EmbeddedInfo(engine, board, score, depth, self.depth)
+
+    def search(self, engine: SimpleEngine, board: Board, node: ChildNode) -> InfoDict:
+        info = super().search(engine, board, node)
+        self.set_node_details(node, info["score"], info.get("depth", self.depth))
+        return info
+
+    def save_dataset(self, data, headers) -> None:
+        try:
+            if self.dataset is not None:
+                self.dataset.replace(data, headers)
+            else:
+                replace_game(data, headers, self.root)
+            logger.debug(f"Replaced the analysis of {headers.get('Site')} in {self.root}")
+        except Exception:
+            logger.exception("Could not replace the analysis in the dataset...")
+
+    def game_analysis(self):
+        game = super().game_analysis()
+        if self.store_game:
+            self.update_game(game, game.headers.get("Site"))
+        return game
@@ -2,6 +2,7 @@
 
 """Manages download and storage of lichess games based on game id or user API token"""
 
+import io
 import os
 import sys
 import requests
@@ -9,6 +10,10 @@ import logging
 # from chesspuzzler.constants import Constant
 import chess.pgn
 import pandas as pd
+from typing import Dict, Iterable, Iterator, List, Optional
+from chesspuzzler.analysis.analysis_dataset import DATASET_DIR, AnalysisDataset, append_game
+from chesspuzzler.analysis.game_store import default_store
+from chesspuzzler.analysis.http_client import RateLimitedSession, lichess_session
 
 # Create logging folder if it does not exist
 os.makedirs("./data/logging", exist_ok=True)
@@ -21,32 +26,21 @@ file_handler.setFormatter(formater)
 logger.addHandler(file_handler)
 
 class FileManager:
+    # the dataset analyses are added to, None to write each one straight away
+    dataset: Optional[AnalysisDataset] = None
 
     @staticmethod
     def save_url_game_content(file_object, game_id):
-        parent_dir = os.path.join(".", "data")
-        child_dir = os.path.join(parent_dir, "game_data")
-        os.makedirs(child_dir, exist_ok=True)
-
-        file_name = f'lichess_{game_id}.pgn'
-        file_path = os.path.join(child_dir, file_name)
+        store = default_store()
         try:
-            with open(file_path, mode="w") as file:
-                logger.debug(f"Created file {file_name}...")
-                try:
-                    file.writelines(file_object.content.decode())
-                    logger.debug(f"Added pgn content from Lichess from game id {game_id} to file...")
-                except:
-                    logger.exception(f"Could not add content to {file_path}...")
-                    sys.exit(1)
-
-        except FileNotFoundError:
-            print(f"{file_path} not found...")
-            print("Ensure you're in chess_mixer directory...")
-            logger.exception(f"{file_path} not found...")
-            sys.exit(1)
+            store.put(game_id, file_object.content.decode())
+            logger.debug(f"Added pgn content from Lichess from game id {game_id} to the game store...")
+        except Exception:
+            # raised rather than exiting, a caller storing many games decides what a failure means
+            logger.exception(f"Could not add game {game_id} to {store.root}...")
+            raise
 
-        logger.debug(f"File: {file_name} has been stored in {child_dir}")
+        logger.debug(f"Game: {game_id} has been stored in {store.root}")
 
 
     def load_pgn_game(self, game_id):
@@ -55,36 +49,44 @@ class FileManager:
             logger.error("No game id provided...")
             sys.exit(1)
 
-        file_name = f"lichess_{game_id}.pgn"
-        file_path = os.path.join(".", "data", "game_data", file_name)
-        
-        if not self.file_exists(file_path):
-            return False
-        
-        with open(file_path) as file:
-            game = chess.pgn.read_game(file)
-            if game is None:
-                logger.debug(f"File {file_name} is empty, delecting file...")
-                os.remove(file_path)
-                logger.debug(f"{file_name} delected...")
+        store = default_store()
+        pgn = store.get(game_id)
+        file_path = None
+        if pgn is None:
+            # games saved before the store, not migrated yet
+            file_name = f"lichess_{game_id}.pgn"
+            file_path = os.path.join(".", "data", "game_data", file_name)
+            if not self.file_exists(file_path):
                 return False
+            with open(file_path) as file:
+                pgn = file.read()
+
+        game = chess.pgn.read_game(io.StringIO(pgn))
+        if game is None:
+            logger.debug(f"Game {game_id} is empty, delecting it...")
+            if file_path:
+                os.remove(file_path)
             else:
-                logger.info(f"GAME LOADING SUCCESSFUL...\n{game}")
-                return game
+                store.delete(game_id)
+            logger.debug(f"{game_id} delected...")
+            return False
+        else:
+            logger.info(f"GAME LOADING SUCCESSFUL...\n{game}")
+            return game
     
     def file_exists(self, file_path) -> bool:
         if os.path.exists(file_path):
             return True
         return False
     
-    def save_dataframe(self, data: pd.DataFrame, game_url: str) -> None:
+    def save_dataframe(self, data: pd.DataFrame, game_url: str, suffix: str = "") -> None:
         parent_dir = os.path.join(".", "data")
         child_dir = os.path.join(parent_dir, "chess_analysis_report")
         os.makedirs(child_dir, exist_ok=True)
 
         if isinstance(data, pd.DataFrame) or isinstance(data, pd.Series):
             game_id = game_url.split("/")[-1]
-            file_name = f"lichess_{game_id}.csv"
+            file_name = f"lichess_{game_id}{suffix}.csv"
             file_path = os.path.join(child_dir, file_name)
             try:
                 data.to_csv(file_path)
@@ -92,17 +94,38 @@ class FileManager:
             except:
                 logger.exception("Could not save Dataframe to CSV...")
 
+    def save_dataset(self, data: pd.DataFrame, headers) -> None:
+        try:
+            if self.dataset is not None:
+                self.dataset.append(data, headers)
+            else:
+                append_game(data, headers)
+            logger.debug(f"Analysis of {headers.get('Site')} added to {DATASET_DIR}...")
+        except:
+            logger.exception("Could not add analysis to the dataset...")
+
     def update_game(self, game: str, game_url: str) -> None:
         game_id = game_url.split("/")[-1]
-        file_name = f"lichess_{game_id}.pgn"
-        file_path = os.path.join(".", "data", "game_data", file_name)
         try:
-            with open(file_path, "w") as file:
-                export = chess.pgn.FileExporter(file)
-                game.accept(export)
-                logger.debug(f"{file_name} has successfully been re-written...")
+            export = chess.pgn.StringExporter()
+            default_store().put(game_id, game.accept(export))
+            logger.debug(f"Game {game_id} has successfully been re-written...")
         except:
-            logger.exception("Could not re-write file...")
+            logger.exception("Could not re-write game...")
+
+
+def split_pgn_games(lines: Iterable[str]) -> Iterator[str]:
+    """Splits the lines of a multi-game PGN into the text of each game."""
+    game: List[str] = []
+    blank = True
+    for line in lines:
+        if blank and line.startswith("[") and not line.startswith("[%") and game:
+            yield "".join(game)
+            game = []
+        game.append(line)
+        blank = not line.strip()
+    if "".join(game).strip():
+        yield "".join(game)
 
 
 class GameDownloader(FileManager):
@@ -113,15 +136,27 @@ class GameDownloader(FileManager):
             if true then .json file location should be provided.
             if false then game id is to be provided.
     """
+    LICHESS_SITE = "https://lichess.org/"
+    # lichess exports at most this many games per request by ids
+    MAX_IDS_PER_REQUEST = 300
+
+    _session: Optional[RateLimitedSession] = None
+
+    @property
+    def session(self) -> RateLimitedSession:
+        """One pooled, rate limited session for every request of this downloader."""
+        if self._session is None:
+            self._session = lichess_session()
+        return self._session
+
     def get_game_via_gameid(self, game_id="") -> None:
         if game_id:
             self.game_id = game_id
-            LICHESS_SITE = "https://lichess.org/"
             TASK = "game/export/"
-            url = LICHESS_SITE + TASK + game_id
+            url = self.LICHESS_SITE + TASK + game_id
 
             try:
-                r = requests.get(url)
+                r = self.session.get(url)
             except requests.exceptions.RequestException:
                 print(f"Could not access {game_id} via http...")
                 logger.exception(f"Could not access {game_id} via http...")
@@ -136,6 +171,52 @@ class GameDownloader(FileManager):
         else:
             self.set_game_id()
 
+    def get_games_via_gameids(self, game_ids: Iterable[str], batch_size: int = MAX_IDS_PER_REQUEST) -> Dict[str, str]:
+        """
+        Downloads games into the game store, `batch_size` ids per request,
+        streaming each multi-game response. Returns the ids that could not
+        be stored, with the reason, instead of exiting.
+        """
+        url = self.LICHESS_SITE + "api/games/export/_ids"
+        batch_size = min(batch_size, self.MAX_IDS_PER_REQUEST)
+        game_ids = list(dict.fromkeys(game_ids))
+        store = default_store()
+        failures: Dict[str, str] = {}
+
+        for start in range(0, len(game_ids), batch_size):
+            # lichess answers with the 8 character game id, full ids carry the player too,
+            # so one game can be asked for under several full ids
+            pending: Dict[str, List[str]] = {}
+            for game_id in game_ids[start:start + batch_size]:
+                pending.setdefault(game_id[:8], []).append(game_id)
+            try:
+                with self.session.post(
+                    url,
+                    data=",".join(pending),
+                    params={"clocks": "true", "evals": "true"},
+                    headers={"Accept": "application/x-chess-pgn"},
+                    stream=True,
+                ) as r:
+                    if r.status_code != 200:
+                        logger.error(f"Lichess answered {r.status_code} for {len(pending)} game ids...")
+                        failures.update((game_id, f"HTTP {r.status_code}") for ids in pending.values() for game_id in ids)
+                        continue
+                    r.encoding = r.encoding or "utf-8"
+                    lines = (line + "\n" for line in r.iter_lines(decode_unicode=True))
+                    for pgn in split_pgn_games(lines):
+                        game = chess.pgn.read_headers(io.StringIO(pgn))
+                        site_id = game.get("Site", "").split("/")[-1] if game else ""
+                        if site_id in pending:
+                            store.put_many((game_id, pgn) for game_id in pending.pop(site_id))
+            except requests.exceptions.RequestException as e:
+                logger.exception(f"Could not download {len(pending)} game ids via http...")
+                failures.update((game_id, str(e)) for ids in pending.values() for game_id in ids)
+                continue
+            failures.update((game_id, "not found") for ids in pending.values() for game_id in ids)
+
+        logger.debug(f"Stored {len(game_ids) - len(failures)} of {len(game_ids)} games, {len(failures)} failed...")
+        return failures
+
     def set_game_id(self):
         self.game_id = input("Enter valid Lichess game id: ")
         if self.game_id:
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+"""Packed, append-only storage of PGN games keyed by game id."""
+
+import argparse
+import glob
+import os
+import struct
+import zlib
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
+from chesspuzzler.analysis.logger import configure_log
+
+logger = configure_log(__name__, "game_store.log")
+
+STORE_DIR = os.path.join(".", "data", "game_store")
+LEGACY_DIR = os.path.join(".", "data", "game_data")
+
+# a record is its compressed length followed by the zlib compressed pgn
+RECORD_HEADER = struct.Struct(">I")
+
+
+class GameStore:
+    """
+    Games are zlib compressed one by one and appended to segment files
+    (`segment_00000.bin`, ...) that roll over at `segment_size`. The
+    append-only `index.tsv` maps a game id to its segment, offset and
+    length, and the last line for an id wins, so an update is just
+    another append. Lookups are one dict hit and one read; `scan` reads
+    the live records segment by segment in file order.
+
+    Only one process should write to a store at a time.
+    """
+    segment_size = 256 * 1024 * 1024
+
+    def __init__(self, root: str = STORE_DIR) -> None:
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.index_path = os.path.join(root, "index.tsv")
+        self.index: Dict[str, Tuple[int, int, int]] = {}
+        self.readers: Dict[int, BinaryIO] = {}
+        self.writer: Optional[BinaryIO] = None
+        self.index_writer = None
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, newline = "") as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        # cut short by a crash, or being appended by a writer
+                        continue
+                    fields = line[:-1].split("\t")
+                    if len(fields) != 4:
+                        logger.warning(f"Skipping malformed index line {line!r} in {self.index_path}")
+                        continue
+                    game_id, segment, offset, length = fields
+                    if segment == "-1":
+                        self.index.pop(game_id, None)
+                    else:
+                        self.index[game_id] = (int(segment), int(offset), int(length))
+
+        segments = glob.glob(os.path.join(root, "segment_*.bin"))
+        self.segment = max((int(os.path.basename(path)[8:13]) for path in segments), default = 0)
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.root, f"segment_{segment:05d}.bin")
+
+    def __contains__(self, game_id: str) -> bool:
+        return game_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, game_id: str) -> Optional[str]:
+        if game_id not in self.index:
+            return None
+        segment, offset, length = self.index[game_id]
+        if segment not in self.readers:
+            self.readers[segment] = open(self.segment_path(segment), "rb")
+        reader = self.readers[segment]
+        reader.seek(offset + RECORD_HEADER.size)
+        return zlib.decompress(reader.read(length)).decode()
+
+    def put(self, game_id: str, pgn: str) -> None:
+        self.put_many([(game_id, pgn)])
+
+    def put_many(self, games: Iterable[Tuple[str, str]]) -> None:
+        """Appends `(game_id, pgn)` pairs, flushing the segment and the index once."""
+        entries = []
+        for game_id, pgn in games:
+            data = zlib.compress(pgn.encode())
+            if self.writer is None:
+                self.writer = open(self.segment_path(self.segment), "ab")
+            offset = self.writer.tell()
+            if offset and offset + RECORD_HEADER.size + len(data) > self.segment_size:
+                self.writer.close()
+                self.segment += 1
+                self.writer = open(self.segment_path(self.segment), "ab")
+                offset = 0
+            self.writer.write(RECORD_HEADER.pack(len(data)) + data)
+            entries.append((game_id, self.segment, offset, len(data)))
+        if not entries:
+            return
+        assert self.writer is not None
+        self.writer.flush()
+        # the records are written before the index points at them
+        for entry in entries:
+            self.append_index(*entry, flush = False)
+            self.index[entry[0]] = entry[1:]
+        assert self.index_writer is not None
+        self.index_writer.flush()
+
+    def delete(self, game_id: str) -> None:
+        if self.index.pop(game_id, None):
+            self.append_index(game_id, -1, 0, 0)
+
+    def append_index(self, game_id: str, segment: int, offset: int, length: int, flush: bool = True) -> None:
+        if self.index_writer is None:
+            self.repair_index()
+            self.index_writer = open(self.index_path, "a")
+        self.index_writer.write(f"{game_id}\t{segment}\t{offset}\t{length}\n")
+        if flush:
+            self.index_writer.flush()
+
+    def repair_index(self) -> None:
+        """
+        Cuts a line left unfinished by a crash off the end of the index, so
+        appends start on a line of their own. Done before the first write
+        only: a store opened to read could otherwise cut the line a writer
+        is in the middle of appending.
+        """
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb+") as file:
+            size = file.seek(0, os.SEEK_END)
+            # a fragment is shorter than a line, which is far shorter than this
+            start = max(0, size - 4096)
+            file.seek(start)
+            tail = file.read()
+            if tail and not tail.endswith(b"\n"):
+                end = start + tail.rfind(b"\n") + 1
+                logger.warning(f"Dropping an unfinished index line {tail[end - start:]!r} from {self.index_path}")
+                file.truncate(end)
+
+    def scan(self) -> Iterator[Tuple[str, str]]:
+        """Yields `(game_id, pgn)` for every stored game, in storage order."""
+        by_position = sorted(self.index.items(), key = lambda item: item[1][:2])
+        segment = None
+        reader: Optional[BinaryIO] = None
+        for game_id, (record_segment, offset, length) in by_position:
+            if record_segment != segment:
+                if reader:
+                    reader.close()
+                segment = record_segment
+                reader = open(self.segment_path(segment), "rb")
+            assert reader is not None
+            # superseded records in between are skipped over
+            reader.seek(offset + RECORD_HEADER.size)
+            yield game_id, zlib.decompress(reader.read(length)).decode()
+        if reader:
+            reader.close()
+
+    def close(self) -> None:
+        for file in [self.writer, self.index_writer, *self.readers.values()]:
+            if file:
+                file.close()
+        self.writer = None
+        self.index_writer = None
+        self.readers = {}
+
+    def __enter__(self) -> "GameStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+_default_store: Optional[GameStore] = None
+
+def default_store() -> GameStore:
+    """The store under `./data/game_store`, shared by the file managers."""
+    global _default_store
+    if _default_store is None:
+        _default_store = GameStore()
+    return _default_store
+
+
+def migrate(source: str = LEGACY_DIR, store: Optional[GameStore] = None, delete: bool = False) -> int:
+    """
+    Moves `lichess_<id>.pgn` files into the store, keeping games already
+    stored. Returns how many games were imported.
+    """
+    store = store if store is not None else default_store()
+    imported = 0
+    for path in sorted(glob.glob(os.path.join(source, "lichess_*.pgn"))):
+        game_id = os.path.basename(path)[len("lichess_"):-len(".pgn")]
+        if game_id not in store:
+            with open(path) as file:
+                pgn = file.read()
+            if not pgn.strip():
+                logger.debug(f"Skipping empty {path}...")
+                continue
+            store.put(game_id, pgn)
+            imported += 1
+        if delete:
+            os.remove(path)
+    logger.info(f"Imported {imported} games from {source} into {store.root}")
+    return imported
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move one-file-per-game PGNs into the packed game store.")
+    parser.add_argument("--source", default=LEGACY_DIR, help="Directory of lichess_<id>.pgn files")
+    parser.add_argument("--store", default=STORE_DIR, help="Game store directory")
+    parser.add_argument("--delete", action="store_true", help="Remove the files once their game is stored")
+    args = parser.parse_args()
+
+    with GameStore(args.store) as store:
+        imported = migrate(args.source, store, args.delete)
+        print(f"Imported {imported} games, {len(store)} games in {args.store}")
+
+
+if __name__ == "__main__":
+    main()
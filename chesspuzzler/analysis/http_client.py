@@ -0,0 +1,293 @@
+"""
+Shared HTTP access for everything that talks to lichess.
+
+`RateLimitedSession` is a `requests.Session`, so it can be handed to
+berserk as well as used directly. Every request waits for a token from
+a `TokenBucket`, a 429 pauses that bucket for the server's cooldown,
+connection errors and 5xx answers are retried a bounded number of times
+with backoff, and connections are kept alive in a pool. Lichess sessions
+draw on a `SharedTokenBucket`, whose state is kept in a locked file so
+that every process on the machine shares the one limit. `HttpMetrics`
+records latency and throttling.
+"""
+
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Deque, Dict, IO, Iterator, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from chesspuzzler.analysis.constants import Constant
+from chesspuzzler.analysis.logger import configure_log
+
+try:
+    import fcntl
+
+    def lock_file(file: IO) -> None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+    def unlock_file(file: IO) -> None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+except ImportError:
+    import msvcrt
+
+    # Windows locks a byte range, the first byte stands for the whole file
+    def lock_file(file: IO) -> None:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+
+    def unlock_file(file: IO) -> None:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+logger = configure_log(__name__, "http.log")
+
+# lichess asks for one request at a time and a full minute of quiet after a 429
+LICHESS_RATE = 1.0
+LICHESS_BURST = 2
+LICHESS_COOLDOWN = 60.0
+
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second with bursts of up to `burst`.
+    Thread safe; `pause` holds every caller until a cooldown is over.
+    The limit holds within one process.
+    """
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, rate: float, burst: float = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = self.clock()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Takes a token, returns the seconds spent waiting for it."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                delay = self.take(self.clock())
+            if delay <= 0:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def take(self, now: float) -> float:
+        """Takes a token if one is free and returns 0, otherwise the seconds until one may be."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.hold(self.clock() + seconds)
+
+    def hold(self, until: float) -> None:
+        self.paused_until = max(self.paused_until, until)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    A `TokenBucket` whose tokens and cooldown are kept in the file at
+    `path`, so every process drawing on it shares one limit. The file is
+    locked while a token is taken, and times are wall clock seconds as
+    monotonic clocks are not comparable between processes.
+    """
+    clock = staticmethod(time.time)
+
+    def __init__(self, path: str, rate: float, burst: float = 1) -> None:
+        super().__init__(rate, burst)
+        self.path = path
+
+    def take(self, now: float) -> float:
+        with self.state():
+            return super().take(now)
+
+    def hold(self, until: float) -> None:
+        with self.state():
+            super().hold(until)
+
+    @contextmanager
+    def state(self) -> Iterator[None]:
+        """Loads the bucket from its file under lock and writes it back after."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a+") as file:
+            lock_file(file)
+            try:
+                file.seek(0)
+                fields = file.read().split()
+                # a new or unreadable file starts from what this process last saw
+                if len(fields) == 3:
+                    try:
+                        self.tokens, self.updated, self.paused_until = map(float, fields)
+                    except ValueError:
+                        pass
+                yield
+                file.seek(0)
+                file.truncate()
+                file.write(f"{self.tokens} {self.updated} {self.paused_until}")
+                file.flush()
+            finally:
+                unlock_file(file)
+
+
+@dataclass
+class HttpMetrics:
+    requests: int = 0
+    retries: int = 0
+    errors: int = 0
+    throttled: int = 0
+    # seconds spent waiting on the rate limit and on 429 cooldowns
+    rate_wait: float = 0.0
+    cooldown_wait: float = 0.0
+    latencies: Deque[float] = field(default_factory = lambda: deque(maxlen = 10_000))
+    lock: threading.Lock = field(default_factory = threading.Lock, repr = False)
+
+    def record(self, **counts: float) -> None:
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def latency(self, seconds: float) -> None:
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def summary(self) -> Dict[str, float]:
+        with self.lock:
+            latencies = sorted(self.latencies)
+        def percentile(p: float) -> float:
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3) if latencies else 0.0
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "rate_wait": round(self.rate_wait, 1),
+            "cooldown_wait": round(self.cooldown_wait, 1),
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+        }
+
+
+class RateLimitedSession(requests.Session):
+    """
+    A pooled session that rate limits, retries and records every request.
+    Without a `bucket` requests are not rate limited but 429s are still
+    waited out.
+    """
+
+    def __init__(
+        self,
+        bucket: Optional[TokenBucket] = None,
+        metrics: Optional[HttpMetrics] = None,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        cooldown: float = LICHESS_COOLDOWN,
+        timeout: float = 60.0,
+        pool_size: int = 10,
+    ) -> None:
+        super().__init__()
+        self.bucket = bucket
+        self.metrics = metrics if metrics is not None else HttpMetrics()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cooldown = cooldown
+        self.timeout = timeout
+        # retries are handled here, not by urllib3
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size, max_retries = 0)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if self.bucket:
+                self.metrics.record(rate_wait = self.bucket.acquire())
+            start = time.monotonic()
+            self.metrics.record(requests = 1)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.metrics.record(errors = 1)
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"{method} {url} failed ({e}), retrying")
+                self.wait_backoff(attempt)
+                attempt += 1
+                continue
+            self.metrics.latency(time.monotonic() - start)
+
+            if response.status_code == 429:
+                self.metrics.record(throttled = 1)
+                cooldown = self.retry_after(response)
+                logger.warning(f"{method} {url} throttled, cooling down for {cooldown:.0f}s")
+                if attempt >= self.max_retries:
+                    return response
+                response.close()
+                if self.bucket:
+                    self.bucket.pause(cooldown)
+                else:
+                    time.sleep(cooldown)
+                self.metrics.record(cooldown_wait = cooldown, retries = 1)
+                attempt += 1
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                self.metrics.record(errors = 1)
+                response.close()
+                self.wait_backoff(attempt)
+                attempt += 1
+                continue
+
+            return response
+
+    def wait_backoff(self, attempt: int) -> None:
+        self.metrics.record(retries = 1)
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1))
+
+    def retry_after(self, response: requests.Response) -> float:
+        value = response.headers.get("Retry-After")
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return self.cooldown
+
+
+# shared by every lichess session of every process
+lichess_bucket = SharedTokenBucket(Constant.LICHESS_RATE_PATH, LICHESS_RATE, LICHESS_BURST)
+lichess_metrics = HttpMetrics()
+
+def lichess_session(token: Optional[str] = None) -> RateLimitedSession:
+    """A session for lichess, drawing on the machine-wide lichess rate limit."""
+    session = RateLimitedSession(lichess_bucket, lichess_metrics)
+    if token:
+        session.headers.update({"Authorization": f"Bearer {token}"})
+    return session
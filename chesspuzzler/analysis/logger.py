@@ -2,7 +2,8 @@ import sys
 import logging
 
 # from chesspuzzler.colours import Color
-from chesspuzzler.analysis.chess_analysis import symbol_uci_move, BoardInfo
+from chesspuzzler.analysis.board_util import symbol_uci_move
+from chesspuzzler.analysis.model import BoardInfo
 from colorama import Fore, Style
 
 
@@ -0,0 +1,140 @@
+"""
+Lichess-style accuracy and average centipawn loss, for many games at once.
+
+The formulas follow lila (`AccuracyPercent`, `WinPercent`): a move's
+accuracy comes from the drop in the mover's win percentage, a side's
+game accuracy is the mean of the volatility-weighted mean and the
+harmonic mean of its move accuracies, where a move's weight is the
+standard deviation of the win percentages in a window around it.
+Everything is computed over the concatenated plies of all games with
+NumPy; games are told apart by `game_id`.
+"""
+
+import numpy as np
+import pandas as pd
+from chesspuzzler.analysis.board_util import win_chances_array
+
+# lila caps centipawns, and counts mates as this much
+CP_CEILING = 1000
+# the engine's score of the initial position
+INITIAL_CP = 15
+
+
+def win_percent(cp) -> np.ndarray:
+    """Win percentage, 0 to 100, of white centipawn scores."""
+    return 50 + 50 * win_chances_array(np.clip(cp, -CP_CEILING, CP_CEILING))
+
+
+def move_accuracy(before, after) -> np.ndarray:
+    """Accuracy, 0 to 100, of moves that took the mover's win percentage from `before` to `after`."""
+    before = np.asarray(before, dtype=np.float64)
+    after = np.asarray(after, dtype=np.float64)
+    raw = 103.1668100711649 * np.exp(-0.04354415386753951 * (before - after)) - 3.166924740191411
+    # lila adds one point for the engine's own uncertainty
+    return np.where(after >= before, 100.0, np.clip(raw + 1, 0, 100))
+
+
+def white_cp(report: pd.DataFrame) -> np.ndarray:
+    """
+    Report scores (`TrackEval.cp` / `mate`, for the mover) as white
+    centipawns, mates at the ceiling.
+    """
+    cp = report["cp"].astype("float64").to_numpy()
+    mate = report["mate"].astype("float64").to_numpy()
+    # no cp and no mate distance: the mover has just mated
+    cp = np.where(np.isnan(cp), np.where(mate < 0, -CP_CEILING, CP_CEILING), cp)
+    cp = np.where(mate > 0, CP_CEILING, np.where(mate < 0, -CP_CEILING, cp))
+    white = report["move_number"].to_numpy() % 2 == 1
+    return np.where(white, cp, -cp)
+
+
+def ply_metrics(report: pd.DataFrame) -> pd.DataFrame:
+    """
+    Per ply of stacked reports (in ply order within each game): the
+    move's accuracy, its centipawn loss and its weight in game accuracy.
+    """
+    n = len(report)
+    games = report["game_id"].to_numpy() if "game_id" in report else np.zeros(n)
+    first = np.ones(n, dtype=bool)
+    first[1:] = games[1:] != games[:-1]
+    game = np.cumsum(first) - 1
+    starts = np.flatnonzero(first)
+    moves = np.diff(np.append(starts, n))
+
+    # each game's scores with the initial position in front, in one array
+    cp = np.clip(white_cp(report), -CP_CEILING, CP_CEILING)
+    position = np.arange(n) + game + 1
+    scores = np.full(n + len(starts), float(INITIAL_CP))
+    scores[position] = cp
+    wins = win_percent(scores)
+    before, after = wins[position - 1], wins[position]
+    cp_before, cp_after = scores[position - 1], scores[position]
+
+    white = report["move_number"].to_numpy() % 2 == 1
+    accuracy = np.where(white, move_accuracy(before, after), move_accuracy(100 - before, 100 - after))
+    loss = np.maximum(0, np.where(white, cp_before - cp_after, cp_after - cp_before))
+
+    # window of a game's win percentages each move is weighted by, as lila slides it
+    size = np.minimum(np.clip(moves // 10, 2, 8), moves + 1)[game]
+    index = np.arange(n) - starts[game]
+    window_start = (starts + np.arange(len(starts)))[game] + np.maximum(0, index - (size - 2))
+    sums = np.concatenate([[0.0], np.cumsum(wins)])
+    squares = np.concatenate([[0.0], np.cumsum(wins * wins)])
+    mean = (sums[window_start + size] - sums[window_start]) / size
+    variance = np.maximum(0, (squares[window_start + size] - squares[window_start]) / size - mean * mean)
+    weight = np.clip(np.sqrt(variance), 0.5, 12)
+
+    return pd.DataFrame({"accuracy": accuracy, "cp_loss": loss, "weight": weight}, index=report.index)
+
+
+def game_metrics(report: pd.DataFrame) -> pd.DataFrame:
+    """
+    Accuracy, average and total centipawn loss and move count of each side
+    of each game in stacked reports, indexed by `game_id` (when present)
+    and `side`.
+    """
+    if "game_id" in report:
+        # dataset scans do not keep a game's rows together
+        report = report.sort_values(["game_id", "move_number"], kind="stable")
+    plies = ply_metrics(report)
+    keys = [report["game_id"]] if "game_id" in report else []
+    sides = np.where(report["move_number"].to_numpy() % 2 == 1, "White", "Black")
+    frame = pd.DataFrame({
+        "accuracy": plies["accuracy"].to_numpy(),
+        "weighted": plies["accuracy"].to_numpy() * plies["weight"].to_numpy(),
+        "weight": plies["weight"].to_numpy(),
+        # lila takes the harmonic mean of accuracies of at least 1
+        "inverse": 1 / np.maximum(1, plies["accuracy"].to_numpy()),
+        "cp_loss": plies["cp_loss"].to_numpy(),
+    })
+    grouped = frame.groupby([key.to_numpy() for key in keys] + [sides], sort=False)
+    totals = grouped.sum()
+    count = grouped.size()
+    metrics = pd.DataFrame({
+        "accuracy": ((totals["weighted"] / totals["weight"] + count / totals["inverse"]) / 2).round(1),
+        "acpl": (totals["cp_loss"] / count).round().astype(int),
+        "cp_loss": totals["cp_loss"],
+        "moves": count,
+    })
+    metrics.index.names = (["game_id"] if keys else []) + ["side"]
+    return metrics
+
+
+def player_metrics(report: pd.DataFrame) -> pd.DataFrame:
+    """
+    Games played, mean game accuracy and average centipawn loss over all
+    their moves, of each player in stacked reports with `white`/`black`.
+    """
+    games = game_metrics(report).reset_index()
+    names = report.drop_duplicates("game_id").set_index("game_id")[["white", "black"]]
+    games["player"] = np.where(
+        games["side"] == "White",
+        names["white"].reindex(games["game_id"]).to_numpy(),
+        names["black"].reindex(games["game_id"]).to_numpy(),
+    )
+    grouped = games.groupby("player")
+    return pd.DataFrame({
+        "games": grouped.size(),
+        "accuracy": grouped["accuracy"].mean().round(1),
+        "acpl": (grouped["cp_loss"].sum() / grouped["moves"].sum()).round().astype(int),
+    })
@@ -1,74 +1,72 @@
-import math
 # import chess
-from chess import Move, Color
-from dataclasses import dataclass, field
-from chess.engine import PovScore, Cp, InfoDict
-from chess.pgn import ChildNode
-from typing import List, ClassVar, Optional
+import time
+from chess import Board, Move, Color
+from dataclasses import dataclass, field, InitVar
+from chess.engine import PovScore, Score, Cp, InfoDict
+from chess.pgn import ChildNode, Game
+from typing import Dict, List, ClassVar, Optional
+from chesspuzzler.analysis.board_util import score_win_chances, wdl_score
 
 
-@dataclass
+@dataclass(slots=True)
 class TrackEval:
-    povscore: PovScore
-    turn: int
-   
-    def __post_init__(self):
-        self.score = self.povscore.pov(self.turn)
-        self.set_mate()
-        self.set_cp()
-        self.wdl = self.wdl_score()
-        self.engine_wdl = self.povscore.pov(self.turn).wdl(model="sf15.1").expectation()
-        self.mateCreated = self.mate > 0
-        self.inCheckMate = self.mate < 0
-        self.noMateFound = not self.mate
+    """
+    A score from the point of view of `turn`. The view is taken once and
+    only what the judgement reads is kept.
+    """
+    povscore: InitVar[PovScore]
+    turn: Color
+    score: Score = field(init=False)
+    mate: int = field(init=False)
+    cp: Optional[int] = field(init=False)
+    wdl: float = field(init=False)
 
-    def set_mate(self):
-        mate = self.povscore.pov(self.turn).mate()
+    def __post_init__(self, povscore: PovScore):
+        self.score = povscore.pov(self.turn)
+        mate = self.score.mate()
+        self.mate = mate or 0
         if mate:
-            self.mate = mate
+            self.cp = 100_000 if mate > 0 else -100_000
         else:
-            self.mate = 0
+            self.cp = self.score.score()
+        self.wdl = self.wdl_score()
 
-    def set_cp(self):
-        cp = self.povscore.pov(self.turn)
+    @property
+    def mateCreated(self) -> bool:
+        return self.mate > 0
 
-        if cp.mate():
-            self.cp = 100_000 if cp.mate() > 0 else -100_000
-        else:
-            self.cp = cp.score()
+    @property
+    def inCheckMate(self) -> bool:
+        return self.mate < 0
+
+    @property
+    def noMateFound(self) -> bool:
+        return not self.mate
 
     def win_chances(self):
         """
         winning chances from -1 to 1
         https://lichess.org/page/accuracy
         """
-        mate = self.povscore.pov(self.turn).mate()
-        if mate is not None:
-            return 1 if mate > 0 else -1
-
-        cp = self.povscore.pov(self.turn).score()
-        MULTIPLIER = (
-            -0.003682081729595926
-        )  # https://github.com/lichess-org/lila/pull/11148
-        return 2 / (1 + math.exp(MULTIPLIER * cp)) - 1 if cp is not None else 0
+        return score_win_chances(self.score.score(), self.score.mate())
 
     def wdl_score(self):
-        win_chances = self.win_chances()
-        return (50 + 50 * win_chances) * 0.01
+        return wdl_score(self.win_chances())
 
-@dataclass
+@dataclass(slots=True)
 class EngineMove:
-    info: InfoDict
+    """The first move of an engine line and its score, the rest of the `InfoDict` is not kept."""
+    info: InitVar[InfoDict]
     turn: Color
+    move: Move = field(init=False)
+    score: TrackEval = field(init=False)
 
-    def __post_init__(self):
-        self.move = self.info["pv"][0]
-        self.continuation = self.info["pv"]
-        # self.score = self.info["score"]
-        self.score = TrackEval(self.info["score"], self.turn)
+    def __post_init__(self, info: InfoDict):
+        self.move = info["pv"][0]
+        self.score = TrackEval(info["score"], self.turn)
 
 
-@dataclass
+@dataclass(slots=True)
 class CandidateMoves:
     # node: ChildNode
     turn: Color
@@ -76,19 +74,62 @@ class CandidateMoves:
     second: Optional[EngineMove]
 
 
-@dataclass
+@dataclass(slots=True)
 class BoardInfo:
+    """
+    The move of `node` and the position after it. `board`, when given,
+    is that position already replayed, which spares rebuilding it from
+    the root of the game; it is only read here.
+    """
     node: ChildNode
+    board: InitVar[Optional[Board]] = None
+    side: str = field(init=False)
+    turn: Color = field(init=False)
+    fen: str = field(init=False)
+    move: Move = field(init=False)
+    half_move_number: int = field(init=False)
+    fullmove_number: int = field(init=False)
 
-    def __post_init__(self):
-        self.board = self.node.board()
-        self.side = "White" if not self.board.turn else "Black"
-        self.turn = not self.board.turn
-        self.fen = self.board.fen()
+    def __post_init__(self, board: Optional[Board]):
+        if board is None:
+            board = self.node.board()
+            self.half_move_number = self.node.ply()
+        else:
+            self.half_move_number = board.ply()
+        self.side = "White" if not board.turn else "Black"
+        self.turn = not board.turn
+        self.fen = board.fen()
         self.move = self.node.move
-        self.half_move_number = self.node.ply()
-        self.fullmove_number = self.board.fullmove_number if self.turn else self.board.fullmove_number - 1
-    
+        self.fullmove_number = board.fullmove_number if self.turn else board.fullmove_number - 1
+
     def get_info(self):
         board_info_list = [self.half_move_number, self.move, self.side, self.fen]
         return board_info_list
+
+
+def measure_ply_models(game: Game, repeat: int = 10) -> Dict[str, float]:
+    """
+    Mean microseconds per ply spent building the per-ply models of
+    `game`, replayed `repeat` times the way `GameAnalysis` does. Plies
+    without an eval in the game are scored as a small white advantage.
+    """
+    nodes = list(game.mainline())
+    scores = [node.eval() or PovScore(Cp(20), True) for node in nodes]
+    totals = {"BoardInfo": 0.0, "TrackEval": 0.0, "EngineMove": 0.0}
+    for _ in range(repeat):
+        board = game.board()
+        for node, score in zip(nodes, scores):
+            board.push(node.move)
+            start = time.perf_counter()
+            BoardInfo(node, board)
+            middle = time.perf_counter()
+            # the current and previous evals of each judged move
+            TrackEval(score, not board.turn)
+            TrackEval(score, not board.turn)
+            end = time.perf_counter()
+            EngineMove({"pv": [node.move], "score": score}, not board.turn)
+            totals["BoardInfo"] += middle - start
+            totals["TrackEval"] += end - middle
+            totals["EngineMove"] += time.perf_counter() - end
+    plies = max(len(nodes) * repeat, 1)
+    return {name: total / plies * 1e6 for name, total in totals.items()}
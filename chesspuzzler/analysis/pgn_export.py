@@ -0,0 +1,64 @@
+"""
+Writes analysed games back out as annotated PGN.
+
+`GameAnalysis(annotate=True)` leaves `[%eval]`, a NAG (`??`, `?`, `?!`)
+and a best-move comment on the moves it judged; `AnnotatedExporter`
+collects such games and writes them `batch_size` at a time, appended to
+one PGN file or put into the game store, instead of rewriting a file
+per game.
+"""
+
+from typing import List, Tuple
+import chess.pgn
+from chesspuzzler.analysis.game_store import default_store
+from chesspuzzler.analysis.logger import configure_log
+
+logger = configure_log(__name__, "analysis.log")
+
+# the game store, rather than a PGN file
+STORE_TARGET = "store"
+
+# games exported per write
+EXPORT_BATCH = 100
+
+
+class AnnotatedExporter:
+    """
+    Exports games to `target`, a PGN file that is appended to or
+    `STORE_TARGET`. Pending games are written on `flush`, every
+    `batch_size` games and on `close`.
+    """
+
+    def __init__(self, target: str = STORE_TARGET, batch_size: int = EXPORT_BATCH) -> None:
+        self.target = target
+        self.batch_size = batch_size
+        self.pending: List[Tuple[str, str]] = []
+        self.exported = 0
+
+    def add(self, game: chess.pgn.Game) -> None:
+        game_id = game.headers.get("Site", "").split("/")[-1]
+        exporter = chess.pgn.StringExporter(headers=True, variations=True, comments=True)
+        self.pending.append((game_id, game.accept(exporter)))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        if self.target == STORE_TARGET:
+            default_store().put_many(self.pending)
+        else:
+            with open(self.target, "a") as file:
+                file.write("".join(f"{pgn}\n\n" for _, pgn in self.pending))
+        self.exported += len(self.pending)
+        logger.debug(f"Exported {len(self.pending)} annotated games to {self.target}")
+        self.pending = []
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self) -> "AnnotatedExporter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
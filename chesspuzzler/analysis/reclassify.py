@@ -0,0 +1,185 @@
+"""
+Move judgements recomputed in bulk from stored evaluations.
+
+`classify` applies the rules of `EvaluationEngine.position_classification`,
+`evaluate` and `further_analysis` to whole arrays of plies with NumPy,
+so thresholds can be changed and millions of plies re-judged without an
+engine. Scores are `TrackEval.cp` / `TrackEval.mate` values from the
+mover's point of view: centipawns (±100000 for a mate, NaN when the
+score is a delivered or suffered mate) and the mate distance (0 for none).
+"""
+
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+from chesspuzzler.analysis.board_util import win_chances_array, wdl_array
+from chesspuzzler.analysis.chess_analysis import Judgement
+
+JUDGEMENTS = [judgement.value for judgement in Judgement]
+# index of a judgement in JUDGEMENTS; -1 stands for the plies EvaluationEngine leaves unjudged
+BLUNDER, MISTAKE, INACCURACY, GOOD, EXCELLENT, BEST, DECISIVE, BRILLANT, FORCED = range(len(JUDGEMENTS))
+UNJUDGED = -1
+
+
+@dataclass(frozen=True)
+class Thresholds:
+    """The limits `EvaluationEngine` judges with."""
+    # drops in expected score
+    blunder: float = 0.2
+    mistake: float = 0.1
+    inaccuracy: float = 0.05
+    # smaller drops of a move that is not the engine's are still Good
+    judged_drop: float = 0.02
+    excellent_drop: float = 0.009
+    # below this expected score a best move cannot be brilliant
+    losing_wdl: float = 0.49
+    # score left after missing a mate, or before running into one
+    missed_mate_inaccuracy_cp: int = 999
+    missed_mate_mistake_cp: int = 700
+    material_cp: int = 100
+    # winning chances the best move has over the second one to be brilliant
+    brilliant_margin: float = 0.6
+
+
+def track_wdl(cp, mate) -> np.ndarray:
+    """`TrackEval.wdl` of arrays of `TrackEval.cp` and `TrackEval.mate`."""
+    cp = np.asarray(cp, dtype=np.float64)
+    mate = np.asarray(mate, dtype=np.float64)
+    # a NaN cp is a mate of distance 0, which counts as lost
+    mate = np.where(mate != 0, mate, np.where(np.isnan(cp), 0.0, np.nan))
+    return wdl_array(win_chances_array(cp, mate))
+
+
+def flags(values, size: int) -> np.ndarray:
+    return np.zeros(size, dtype=bool) if values is None else np.asarray(values, dtype=bool)
+
+
+def scores(values, size: int) -> np.ndarray:
+    return np.full(size, np.nan) if values is None else np.asarray(values, dtype=np.float64)
+
+
+def classify(
+    cp,
+    mate,
+    prev_cp,
+    prev_mate,
+    best_played=None,
+    forced=None,
+    checkmate=None,
+    up_material=None,
+    candidate_best_cp=None,
+    candidate_best_mate=None,
+    candidate_second_cp=None,
+    candidate_second_mate=None,
+    played_candidate_best=None,
+    played_candidate_second=None,
+    thresholds: Thresholds = Thresholds(),
+) -> np.ndarray:
+    """
+    Judgement codes (indices into `JUDGEMENTS`, `UNJUDGED` for none) of
+    each ply. `cp`/`mate` score the position after the move and
+    `prev_cp`/`prev_mate` the one before it, both for the mover.
+
+    The flags say whether the move was the engine's best in the previous
+    position, the only legal move, checkmate, and whether the mover was
+    up in material. The candidate scores are the multipv search
+    `further_analysis` makes, NaN where it made none, with flags for the
+    played move being either candidate. Absent arrays are all False / NaN.
+    """
+    t = thresholds
+    cp = np.asarray(cp, dtype=np.float64)
+    mate = np.asarray(mate, dtype=np.float64)
+    prev_cp = np.asarray(prev_cp, dtype=np.float64)
+    prev_mate = np.asarray(prev_mate, dtype=np.float64)
+    n = len(cp)
+    best_played, forced, up_material = flags(best_played, n), flags(forced, n), flags(up_material, n)
+    checkmate = np.isnan(cp) & (mate == 0) if checkmate is None else flags(checkmate, n)
+    best_cp, best_mate = scores(candidate_best_cp, n), scores(candidate_best_mate, n)
+    second_cp, second_mate = scores(candidate_second_cp, n), scores(candidate_second_mate, n)
+    played_best, played_second = flags(played_candidate_best, n), flags(played_candidate_second, n)
+
+    wdl = track_wdl(cp, mate)
+    prev_wdl = track_wdl(prev_cp, prev_mate)
+    drop = prev_wdl - wdl
+
+    # further_analysis: the played candidate's score stands in for the move's
+    fa_cp = np.where(played_second, second_cp, np.where(played_best, best_cp, cp))
+    fa_wdl = np.where(played_second, track_wdl(second_cp, second_mate), np.where(played_best, track_wdl(best_cp, best_mate), wdl))
+    fa_rule = np.where((prev_wdl - fa_wdl >= t.excellent_drop) & ~played_best, EXCELLENT, BEST)
+    # board_util.win_chances reads a cp of 0 or None as 10000
+    quirk = lambda values: np.where(np.isnan(values) | (values == 0), 10_000, values)
+    has_second = ~np.isnan(second_cp) | ~np.isnan(second_mate)
+    brilliant = has_second & (win_chances_array(quirk(best_cp)) > win_chances_array(quirk(second_cp)) + t.brilliant_margin)
+    further = np.select(
+        [(prev_wdl < t.losing_wdl) & (fa_wdl < t.losing_wdl), up_material & (fa_cp > t.material_cp), brilliant],
+        [fa_rule, fa_rule, BRILLANT],
+        fa_rule,
+    )
+
+    evaluated = np.select(
+        [drop >= t.blunder, drop >= t.mistake, drop >= t.inaccuracy],
+        [BLUNDER, MISTAKE, INACCURACY],
+        GOOD,
+    )
+    missed_mate = np.select(
+        [cp > t.missed_mate_inaccuracy_cp, cp > t.missed_mate_mistake_cp], [INACCURACY, MISTAKE], BLUNDER
+    )
+    walked_into_mate = np.select(
+        [prev_cp < -t.missed_mate_inaccuracy_cp, prev_cp < -t.missed_mate_mistake_cp], [INACCURACY, MISTAKE], BLUNDER
+    )
+
+    mate_sequence = (prev_mate > 0) | (mate > 0)
+    return np.select(
+        [
+            checkmate,
+            forced,
+            mate_sequence & (prev_mate > 0) & (mate < 0),
+            mate_sequence & (prev_mate > 0) & (mate == 0),
+            mate_sequence & (mate > 0) & (prev_mate >= 0),
+            # a mate created from a position that was being mated is left unjudged
+            mate_sequence,
+            (prev_mate == 0) & (mate < 0),
+            (drop >= t.judged_drop) & ~best_played,
+        ],
+        [BEST, FORCED, BLUNDER, missed_mate, further, UNJUDGED, walked_into_mate, evaluated],
+        further,
+    ).astype(np.int8)
+
+
+def judgement_labels(codes) -> np.ndarray:
+    """Judgement values of `classify` codes, None where unjudged."""
+    labels = np.array(JUDGEMENTS + [None], dtype=object)
+    return labels[np.asarray(codes)]
+
+
+def reclassify_report(report: pd.DataFrame, thresholds: Thresholds = Thresholds()) -> pd.Series:
+    """
+    Judgements of the plies of analysis reports (as written by
+    `GameAnalysis` or read from the analysis dataset, several games may
+    be stacked when `game_id` tells them apart) under `thresholds`.
+
+    Reports keep one score per ply, so the previous position's score is
+    the previous row's, seen from the other side, and the first ply starts
+    from an even position. Optional boolean columns `best_played`,
+    `forced`, `checkmate` and `up_material` feed the matching flags;
+    without them only the checkmate flag is derived from the scores, so
+    plies judged through the engine's multipv search come out as by
+    `further_analysis` without candidates.
+    """
+    cp = report["cp"].astype("float64").to_numpy()
+    mate = report["mate"].astype("float64").to_numpy()
+    games = report["game_id"].to_numpy() if "game_id" in report else np.zeros(len(report))
+    first = np.ones(len(report), dtype=bool)
+    first[1:] = games[1:] != games[:-1]
+    prev_cp = np.where(first, 0.0, -np.roll(cp, 1))
+    prev_mate = np.where(first, 0.0, -np.roll(mate, 1))
+    column = lambda name: report[name].to_numpy(dtype=bool) if name in report else None
+    codes = classify(
+        cp, mate, prev_cp, prev_mate,
+        best_played=column("best_played"),
+        forced=column("forced"),
+        checkmate=column("checkmate"),
+        up_material=column("up_material"),
+        thresholds=thresholds,
+    )
+    return pd.Series(judgement_labels(codes), index=report.index, name="evaluation")
@@ -0,0 +1,220 @@
+"""
+Random access to games in large, uncompressed PGN dumps.
+
+`build_index` scans a dump once and writes `<dump>.sorted.idx` next to
+it: one tab separated row per game with its id (the last part of
+`Site`), byte offset, length and a few key headers, sorted by id.
+`DumpIndex` memory-maps the dump and its index, finds a game's row with
+a binary search over the index bytes and reads the game straight from
+its offset. A lookup reads O(log n) index lines and nothing is loaded
+up front, so re-processing a subset of games of a month of ~100M games
+does not mean re-scanning or parsing the whole month.
+"""
+
+import csv
+import glob
+import heapq
+import io
+import mmap
+import os
+import chess.pgn
+from chess.pgn import Game
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from chesspuzzler.generator.ingest import parse_header
+from chesspuzzler.analysis.logger import configure_log
+
+logger = configure_log(__name__, "puzzle_gen.log")
+
+# rows sorted by id, unlike the file-ordered `.idx` of earlier versions
+INDEX_SUFFIX = ".sorted.idx"
+INDEX_COLUMNS = ["id", "offset", "length"]
+KEY_HEADERS = ["White", "Black", "WhiteElo", "BlackElo", "TimeControl", "Termination", "UTCDate"]
+# rows sorted in memory at a time while building an index, the rest is merged from disk
+SORT_ROWS = 500_000
+
+
+def index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+
+def scan_offsets(path: str) -> Iterator[Tuple[int, int, Dict[str, str]]]:
+    """Yields `(offset, length, headers)` for each game of the dump at `path`."""
+    total = os.path.getsize(path)
+    start: Optional[int] = None
+    headers: Dict[str, str] = {}
+    blank = True
+    offset = 0
+    with open(path, "rb") as file:
+        for line in file:
+            is_header = line.startswith(b"[") and not line.startswith(b"[%")
+            if blank and is_header:
+                if start is not None:
+                    yield start, offset - start, headers
+                start, headers = offset, {}
+            if is_header:
+                header = parse_header(line.decode("utf-8", "replace"))
+                if header:
+                    headers[header[0]] = header[1]
+            blank = not line.strip()
+            offset += len(line)
+    if start is not None:
+        yield start, total - start, headers
+
+
+def build_index(path: str) -> str:
+    """Indexes the dump at `path` and returns where the index was written."""
+    if path.endswith((".zst", ".bz2")):
+        raise ValueError(f"{path} is compressed, decompress it to index it")
+    out_path = index_path(path)
+    runs: List[str] = []
+    rows: List[List[str]] = []
+    count = 0
+
+    def spill() -> None:
+        # a sorted run; the sort is stable, so a repeated id keeps its file order
+        run_path = f"{out_path}.run{len(runs)}"
+        rows.sort(key = lambda row: row[0])
+        with open(run_path, "w", newline = "") as file:
+            csv.writer(file, delimiter = "\t", lineterminator = "\n").writerows(rows)
+        runs.append(run_path)
+        rows.clear()
+
+    try:
+        for offset, length, headers in scan_offsets(path):
+            game_id = headers.get("Site", "").split("/")[-1]
+            if not game_id:
+                continue
+            rows.append([game_id, str(offset), str(length)] + [headers.get(key, "") for key in KEY_HEADERS])
+            count += 1
+            if len(rows) >= SORT_ROWS:
+                spill()
+        spill()
+        files = [open(run_path, newline = "") for run_path in runs]
+        try:
+            with open(out_path + ".tmp", "w", newline = "") as file:
+                writer = csv.writer(file, delimiter = "\t", lineterminator = "\n")
+                writer.writerow(INDEX_COLUMNS + KEY_HEADERS)
+                writer.writerows(heapq.merge(*[csv.reader(run, delimiter = "\t") for run in files], key = lambda row: row[0]))
+        finally:
+            for run in files:
+                run.close()
+    finally:
+        for run_path in runs:
+            os.remove(run_path)
+    os.replace(out_path + ".tmp", out_path)
+    logger.info(f"Indexed {count} games of {path}")
+    return out_path
+
+
+class DumpIndex:
+    """
+    A memory-mapped PGN dump and its memory-mapped index, built on first
+    use or when the dump is newer than the index.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        if not os.path.exists(index_path(path)) or os.path.getmtime(index_path(path)) < os.path.getmtime(path):
+            build_index(path)
+        self.index_file = open(index_path(path), "rb")
+        # the index always has its column row, so it is never empty
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.rows_start = self.index.find(b"\n") + 1
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ) if os.path.getsize(path) else None
+
+    def entries(self) -> Iterator[Dict[str, str]]:
+        """Index rows (`id`, `offset`, `length` and `KEY_HEADERS`) in id order, to select games by header."""
+        with open(index_path(self.path), newline = "") as file:
+            yield from csv.DictReader(file, delimiter = "\t")
+
+    def line_start(self, position: int) -> int:
+        """Where the first row starting at or after `position` starts, the index size past the last."""
+        if position <= self.rows_start:
+            return self.rows_start
+        newline = self.index.find(b"\n", position - 1)
+        return len(self.index) if newline < 0 else newline + 1
+
+    def lookup(self, game_id: str) -> Optional[Tuple[int, int]]:
+        """`(offset, length)` of a game in the dump, found by bisecting the index bytes."""
+        key = game_id.encode()
+        size = len(self.index)
+        low, high = self.rows_start, size
+        # the first position whose row has an id of at least `key`
+        while low < high:
+            middle = (low + high) // 2
+            start = self.line_start(middle)
+            if start < size and self.index[start:self.index.find(b"\t", start)] < key:
+                low = middle + 1
+            else:
+                high = middle
+        start = self.line_start(low)
+        if start >= size:
+            return None
+        end = self.index.find(b"\n", start)
+        fields = self.index[start:end if end >= 0 else size].split(b"\t")
+        if fields[0] != key:
+            return None
+        return int(fields[1]), int(fields[2])
+
+    def __contains__(self, game_id: str) -> bool:
+        return self.lookup(game_id) is not None
+
+    def __len__(self) -> int:
+        # counts the rows, for reports rather than lookups
+        return sum(1 for _ in self.entries())
+
+    def pgn(self, game_id: str) -> Optional[str]:
+        found = self.lookup(game_id)
+        if found is None or self.map is None:
+            return None
+        offset, length = found
+        return self.map[offset:offset + length].decode("utf-8")
+
+    def game(self, game_id: str) -> Optional[Game]:
+        pgn = self.pgn(game_id)
+        return chess.pgn.read_game(io.StringIO(pgn)) if pgn else None
+
+    def games(self, game_ids: Iterable[str]) -> Iterator[Tuple[str, Game]]:
+        """Yields the requested games that are in this dump, in file order."""
+        locations = ((self.lookup(game_id), game_id) for game_id in set(game_ids))
+        found = sorted((location, game_id) for location, game_id in locations if location is not None)
+        for _, game_id in found:
+            game = self.game(game_id)
+            if game:
+                yield game_id, game
+
+    def close(self) -> None:
+        if self.map:
+            self.map.close()
+        self.index.close()
+        self.index_file.close()
+        self.file.close()
+
+    def __enter__(self) -> "DumpIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def dump_paths(locations: Iterable[str]) -> List[str]:
+    # plain dumps, given directly or found in a directory
+    paths = []
+    for location in locations:
+        if os.path.isdir(location):
+            paths += sorted(glob.glob(os.path.join(location, "*.pgn")))
+        elif os.path.isfile(location) and location.endswith(".pgn"):
+            paths.append(location)
+    return paths
+
+
+def find_game(game_id: str, locations: Iterable[str]) -> Optional[Game]:
+    """Looks `game_id` up in the local dumps under `locations`."""
+    for path in dump_paths(locations):
+        with DumpIndex(path) as index:
+            game = index.game(game_id)
+            if game:
+                logger.info(f"Found {game_id} in {path}")
+                return game
+    return None
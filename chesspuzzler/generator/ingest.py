@@ -0,0 +1,306 @@
+"""
+Streams games out of multi-game PGN files such as the lichess monthly
+database dumps (`.pgn`, `.pgn.bz2` or `.pgn.zst`).
+
+Games are filtered on their headers before any movetext is parsed, and
+only one game is held in memory at a time, so a dump of tens of millions
+of games can be fed to the generator in constant memory. With several
+workers the file is cut into chunks at game boundaries, which are
+filtered and parsed in a process pool, a bounded number at a time, and
+sent back packed.
+"""
+
+import bz2
+import io
+import multiprocessing
+import multiprocessing.pool
+import os
+import queue
+import re
+import chess.pgn
+from collections import deque
+from dataclasses import dataclass
+from chess.pgn import Game
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO, Tuple, Union
+from chesspuzzler.generator.util import time_control_tier, rating_tier
+from chesspuzzler.generator.mainline import MainlineGame, parse_mainline
+from chesspuzzler.generator.packed import PackedGame
+from chesspuzzler.analysis.logger import configure_log
+
+logger = configure_log(__name__, "puzzle_gen.log")
+
+# bytes of PGN text per chunk handed to a parsing worker
+chunk_size = 16 * 1024 * 1024
+# chunks queued or being parsed per worker
+chunks_in_flight = 2
+
+
+def open_pgn(path: str) -> TextIO:
+    if path.endswith(".zst"):
+        import zstandard
+        raw = open(path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, closefd = True)
+        return io.TextIOWrapper(reader, encoding = "utf-8")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", encoding = "utf-8")
+    return open(path, encoding = "utf-8")
+
+
+@dataclass
+class GameFilter:
+    """Header checks a game has to pass before its movetext is parsed."""
+    # lowest tier, from time control and both ratings, worth generating from
+    min_tier: int = 0
+    # the generator stops at the first ply without an eval
+    require_eval: bool = True
+    # None accepts any termination; games without the header, as outside lichess, always pass
+    terminations: Optional[Tuple[str, ...]] = ("Normal", "Time forfeit")
+    standard_only: bool = True
+
+    def tier(self, header_lines: List[str]) -> int:
+        tiers = []
+        for line in header_lines:
+            tier = time_control_tier(line)
+            if tier is None:
+                tier = rating_tier(line)
+            if tier is not None:
+                tiers.append(tier)
+        return min(tiers) if tiers else 0
+
+    def accept(self, headers: Dict[str, str], tier: int) -> bool:
+        if self.standard_only and headers.get("Variant", "Standard") != "Standard":
+            return False
+        if self.terminations is not None and "Termination" in headers and headers["Termination"] not in self.terminations:
+            return False
+        return tier >= self.min_tier
+
+
+class RawGame(NamedTuple):
+    """A game that passed the header filter, with its movetext still unparsed."""
+    headers: Dict[str, str]
+    movetext: str
+    tier: int
+
+    def mainline(self) -> MainlineGame:
+        return parse_mainline(self.headers, self.movetext)
+
+    def game(self) -> Game:
+        try:
+            return self.mainline().to_game()
+        except ValueError:
+            # variants, null moves and the like are left to python-chess
+            pgn = "".join(f'[{key} "{escape_header(value)}"]\n' for key, value in self.headers.items())
+            return chess.pgn.read_game(io.StringIO(f"{pgn}\n{self.movetext}"))
+
+
+# a backslash escapes a quote or another backslash in a header value
+HEADER_ESCAPE_REGEX = re.compile(r'\\(["\\])')
+
+
+def escape_header(value: str) -> str:
+    # the inverse of `parse_header`'s unescaping
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def parse_header(line: str) -> Optional[Tuple[str, str]]:
+    key, _, value = line.strip()[1:-1].partition(" ")
+    if not key or not value.startswith('"'):
+        return None
+    return key, HEADER_ESCAPE_REGEX.sub(r"\1", value[1:-1])
+
+
+def is_header(line: str) -> bool:
+    # comments such as `[%eval ...]` can start a wrapped movetext line
+    return line.startswith("[") and not line.startswith("[%")
+
+
+def stream_raw_games(lines: Iterable[str], game_filter: Optional[GameFilter] = None) -> Iterator[RawGame]:
+    """
+    Splits PGN `lines` into games and yields the ones `game_filter`
+    accepts. The movetext of a rejected game is skipped line by line
+    and never kept.
+    """
+    game_filter = game_filter or GameFilter()
+    header_lines: List[str] = []
+    headers: Dict[str, str] = {}
+    tier = 0
+    movetext: List[str] = []
+    skip = False
+
+    def finish() -> Optional[RawGame]:
+        if skip or not movetext:
+            return None
+        text = "".join(movetext)
+        if game_filter.require_eval and "[%eval" not in text:
+            return None
+        return RawGame(headers, text, tier)
+
+    for line in lines:
+        if is_header(line):
+            if movetext or skip:
+                raw = finish()
+                if raw:
+                    yield raw
+                header_lines, movetext, skip = [], [], False
+            header_lines.append(line)
+        elif skip or not line.strip():
+            continue
+        elif not movetext:
+            # the whole header is known: decide before keeping any movetext
+            headers = dict(header for header in map(parse_header, header_lines) if header)
+            tier = game_filter.tier(header_lines)
+            skip = not game_filter.accept(headers, tier)
+            if not skip:
+                movetext.append(line)
+        else:
+            movetext.append(line)
+
+    raw = finish()
+    if raw:
+        yield raw
+
+
+# a parsed game, packed to cross processes, or the raw one when only python-chess can read it
+Parsed = Tuple[Union[PackedGame, RawGame], int]
+
+
+def parse_lines(lines: Iterable[str], game_filter: Optional[GameFilter]) -> List[Parsed]:
+    parsed: List[Parsed] = []
+    for raw in stream_raw_games(lines, game_filter):
+        try:
+            parsed.append((PackedGame.from_mainline(raw.mainline()), raw.tier))
+        except ValueError:
+            parsed.append((raw, raw.tier))
+    return parsed
+
+
+def parse_chunk(path: str, start: int, end: int, game_filter: Optional[GameFilter]) -> List[Parsed]:
+    with open(path, "rb") as file:
+        file.seek(start)
+        text = file.read(end - start).decode("utf-8")
+    return parse_text(text, game_filter)
+
+
+def parse_text(text: str, game_filter: Optional[GameFilter]) -> List[Parsed]:
+    # split into lines as a text file is read, unlike str.splitlines which
+    # also breaks at form feeds, \x85 and the other unicode line separators
+    return parse_lines(io.StringIO(text, newline = None), game_filter)
+
+
+def chunk_offsets(path: str, size: int) -> Iterator[Tuple[int, int]]:
+    """
+    Byte ranges of an uncompressed PGN file, each about `size` long and
+    starting at a game: a header line right after a blank line.
+    """
+    total = os.path.getsize(path)
+    start = 0
+    with open(path, "rb") as file:
+        while start < total:
+            file.seek(min(start + size, total))
+            # the line the seek landed in may be a header's tail: never a boundary
+            file.readline()
+            blank = False
+            while True:
+                line = file.readline()
+                if not line:
+                    end = total
+                    break
+                if blank and line.startswith(b"[") and not line.startswith(b"[%"):
+                    end = file.tell() - len(line)
+                    break
+                blank = not line.strip()
+            yield start, end
+            start = end
+
+
+def text_chunks(path: str, size: int) -> Iterator[str]:
+    # compressed files cannot be seeked, so they are cut while reading
+    lines: List[str] = []
+    length = 0
+    blank = False
+    with open_pgn(path) as file:
+        for line in file:
+            if length >= size and blank and line.startswith("[") and not line.startswith("[%"):
+                yield "".join(lines)
+                lines, length = [], 0
+            lines.append(line)
+            length += len(line)
+            blank = not line.strip()
+    if lines:
+        yield "".join(lines)
+
+
+def parse_parallel(path: str, game_filter: Optional[GameFilter], workers: int, ordered: bool = True, size: Optional[int] = None, pool: Optional[multiprocessing.pool.Pool] = None) -> Iterator[Parsed]:
+    """
+    Filters and parses the games of `path` on `pool`, of `workers`
+    processes, or on a pool of `workers` made on the first game. A caller
+    that starts an engine or other threads should create the pool before
+    them, it must not fork with them alive. Games come back in file order
+    when `ordered`, otherwise chunk by chunk as soon as each is parsed.
+    """
+    size = size or chunk_size
+    if path.endswith((".zst", ".bz2")):
+        tasks: Iterator[tuple] = ((parse_text, (text, game_filter)) for text in text_chunks(path, size))
+    else:
+        tasks = ((parse_chunk, (path, start, end, game_filter)) for start, end in chunk_offsets(path, size))
+
+    if pool is not None:
+        yield from submit(pool, tasks, workers, ordered)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            yield from submit(pool, tasks, workers, ordered)
+
+
+def submit(pool: multiprocessing.pool.Pool, tasks: Iterator[tuple], workers: int, ordered: bool) -> Iterator[Parsed]:
+    """Runs the parsing `tasks` on `pool`, with at most `chunks_in_flight` per worker queued."""
+    if ordered:
+        pending: Deque[multiprocessing.pool.AsyncResult] = deque()
+        for function, args in tasks:
+            pending.append(pool.apply_async(function, args))
+            if len(pending) >= workers * chunks_in_flight:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+    else:
+        done: "queue.Queue[Union[List[Parsed], BaseException]]" = queue.Queue()
+        in_flight = 0
+        for function, args in tasks:
+            pool.apply_async(function, args, callback = done.put, error_callback = done.put)
+            in_flight += 1
+            while in_flight >= workers * chunks_in_flight:
+                in_flight -= 1
+                yield from unpack(done.get())
+        while in_flight:
+            in_flight -= 1
+            yield from unpack(done.get())
+
+
+def unpack(result: Union[List[Parsed], BaseException]) -> List[Parsed]:
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def stream_games(path: str, game_filter: Optional[GameFilter] = None, workers: int = 1, ordered: bool = True, pool: Optional[multiprocessing.pool.Pool] = None) -> Iterator[Tuple[Game, int]]:
+    """
+    Yields `(game, tier)` for every game of the PGN file at `path` that
+    passes `game_filter`, parsing on `workers` processes when more than one,
+    those of `pool` if given.
+    """
+    accepted = 0
+    if workers > 1:
+        for parsed, tier in parse_parallel(path, game_filter, workers, ordered, pool = pool):
+            accepted += 1
+            game = parsed.to_game() if isinstance(parsed, PackedGame) else parsed.game()
+            if game is None:
+                continue
+            yield game, tier
+    else:
+        with open_pgn(path) as file:
+            for raw in stream_raw_games(file, game_filter):
+                accepted += 1
+                game = raw.game()
+                if game is None:
+                    continue
+                yield game, raw.tier
+    logger.info(f"{accepted} games from {path} passed the filter")
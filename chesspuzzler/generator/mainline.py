@@ -0,0 +1,203 @@
+"""
+Mainline-only PGN parsing.
+
+`chess.pgn.read_game` builds a node for every move, comment, NAG and
+variation and re-parses annotations each time `node.eval()` is called.
+The analysis and the generator only walk the mainline and its evals, so
+`parse_mainline` reads the movetext with one regex pass into flat arrays
+(moves, evals, eval depths, clocks) and resolves SAN against the board directly.
+`MainlineGame.to_game` is the adapter for code that wants a `Game`.
+"""
+
+import re
+import chess
+import chess.pgn
+from chess import Board, Move, Color
+from chess.engine import Cp, Mate, PovScore
+from chess.pgn import Game, ChildNode, GameNode
+from typing import Dict, List, NamedTuple, Optional
+
+# comment | san | ( | ) | null move
+TOKEN_REGEX = re.compile(r"\{([^}]*)\}|([NBRQK]?[a-h]?[1-8]?x?[a-h][1-8](?:=?[NBRQ])?|O-O-O|O-O|0-0-0|0-0)|(\()|(\))|(--|Z0)")
+
+PIECES = {"N": chess.KNIGHT, "B": chess.BISHOP, "R": chess.ROOK, "Q": chess.QUEEN, "K": chess.KING}
+
+
+class MainlineGame(NamedTuple):
+    """
+    A game as parallel per-ply arrays. Evals are stored from white's
+    point of view as `cps` or `mates` (`None` when the ply has no eval),
+    clocks in seconds.
+    """
+    headers: Dict[str, str]
+    board: Board
+    moves: List[Move]
+    cps: List[Optional[int]]
+    mates: List[Optional[int]]
+    depths: List[Optional[int]]
+    clocks: List[Optional[float]]
+
+    def eval(self, ply: int) -> Optional[PovScore]:
+        """What `node.eval()` returns for the node reached by `moves[ply]`."""
+        return pov_eval(self.cps[ply], self.mates[ply], self.board.turn if ply % 2 else not self.board.turn)
+
+    def to_game(self) -> Game:
+        game = Game(self.headers)
+        game.setup(self.board)
+        node: GameNode = game
+        for ply, move in enumerate(self.moves):
+            node = MainlineNode(node, move, self.eval(ply), self.depths[ply], self.clocks[ply])
+        return game
+
+
+class MainlineNode(ChildNode):
+    """
+    A mainline node that keeps the parsed eval and clock and only writes
+    them into a comment when the comment is first read or changed.
+    """
+
+    def __init__(self, parent: GameNode, move: Move, score: Optional[PovScore], depth: Optional[int], clock: Optional[float]) -> None:
+        super().__init__(parent, move)
+        self.score = score
+        self.depth = depth
+        self.seconds = clock
+        self._comment: Optional[str] = None
+
+    @property
+    def comment(self) -> str:
+        if self._comment is None:
+            self._comment = ""
+            if self.score is not None:
+                ChildNode.set_eval(self, self.score, self.depth)
+            if self.seconds is not None:
+                ChildNode.set_clock(self, self.seconds)
+        return self._comment
+
+    @comment.setter
+    def comment(self, comment: str) -> None:
+        self._comment = comment
+
+    def eval(self) -> Optional[PovScore]:
+        return self.score if self._comment is None else super().eval()
+
+    def eval_depth(self) -> Optional[int]:
+        return self.depth if self._comment is None else super().eval_depth()
+
+    def clock(self) -> Optional[float]:
+        return self.seconds if self._comment is None else super().clock()
+
+
+def pov_eval(cp: Optional[int], mate: Optional[int], turn: Color) -> Optional[PovScore]:
+    # the same conversion `GameNode.eval` does
+    if mate is not None:
+        if mate == 0:
+            return PovScore(Mate(0), turn)
+        score = Mate(mate)
+    elif cp is not None:
+        score = Cp(cp)
+    else:
+        return None
+    return PovScore(score if turn else -score, turn)
+
+
+def parse_san(board: Board, san: str) -> Move:
+    """
+    Resolves SAN from a trusted source with bitboards instead of move
+    generation, falling back to `Board.parse_san` for anything unusual.
+    """
+    if san[0] in "O0":
+        king = board.king(board.turn)
+        if king is None:
+            return board.parse_san(san)
+        # the king moves two squares, as python-chess encodes standard castling
+        return Move(king, king - 2 if san in ["O-O-O", "0-0-0"] else king + 2)
+
+    promotion = None
+    target = san
+    if target[-1] in "NBRQ":
+        promotion = PIECES[target[-1]]
+        target = target[:-2] if target[-2] == "=" else target[:-1]
+    to_square = chess.parse_square(target[-2:])
+    us = board.turn
+
+    if target[0] in PIECES:
+        hint = target[1:-2].replace("x", "")
+        candidates = board.pieces_mask(PIECES[target[0]], us) & board.attackers_mask(us, to_square)
+    else:
+        hint = target[0] if len(target) > 2 else ""
+        pawns = board.pieces_mask(chess.PAWN, us)
+        if hint:
+            candidates = pawns & board.attackers_mask(us, to_square)
+        else:
+            step = -8 if us == chess.WHITE else 8
+            candidates = pawns & chess.BB_SQUARES[to_square + step]
+            if not candidates and not board.occupied & chess.BB_SQUARES[to_square + step]:
+                candidates = pawns & chess.BB_SQUARES[to_square + 2 * step]
+
+    for char in hint:
+        if char in "abcdefgh":
+            candidates &= chess.BB_FILES[ord(char) - ord("a")]
+        else:
+            candidates &= chess.BB_RANKS[int(char) - 1]
+
+    if chess.popcount(candidates) == 1:
+        return Move(chess.lsb(candidates), to_square, promotion)
+    # nothing matched, or the others are pinned
+    legal = [Move(square, to_square, promotion) for square in chess.scan_forward(candidates)]
+    legal = [move for move in legal if board.is_legal(move)]
+    if len(legal) == 1:
+        return legal[0]
+    return board.parse_san(san)
+
+
+def parse_mainline(headers: Dict[str, str], movetext: str) -> MainlineGame:
+    """
+    Parses the mainline of `movetext`, skipping variations. Raises
+    `ValueError` on anything it cannot read the way `read_game` would,
+    e.g. null moves or illegal SAN, so callers can fall back to it.
+    """
+    if headers.get("Variant", "Standard") not in ["Standard", "From Position"]:
+        raise ValueError(f"Unsupported variant {headers['Variant']}")
+    start = Board(headers["FEN"]) if "FEN" in headers else Board()
+    board = start.copy(stack = False)
+    moves: List[Move] = []
+    cps: List[Optional[int]] = []
+    mates: List[Optional[int]] = []
+    depths: List[Optional[int]] = []
+    clocks: List[Optional[float]] = []
+    variation = 0
+
+    for match in TOKEN_REGEX.finditer(movetext):
+        comment, san, open_variation, close_variation, null = match.groups()
+        if open_variation:
+            variation += 1
+        elif close_variation:
+            variation -= 1
+        elif variation:
+            continue
+        elif san:
+            move = parse_san(board, san)
+            board.push(move)
+            moves.append(move)
+            cps.append(None)
+            mates.append(None)
+            depths.append(None)
+            clocks.append(None)
+        elif comment and moves:
+            if cps[-1] is None and mates[-1] is None:
+                eval_match = chess.pgn.EVAL_REGEX.search(comment)
+                if eval_match:
+                    if eval_match.group("mate"):
+                        mates[-1] = int(eval_match.group("mate"))
+                    else:
+                        cps[-1] = round(float(eval_match.group("cp")) * 100)
+                    if eval_match.group("depth"):
+                        depths[-1] = int(eval_match.group("depth"))
+            if clocks[-1] is None:
+                clock_match = chess.pgn.CLOCK_REGEX.search(comment)
+                if clock_match:
+                    clocks[-1] = int(clock_match.group("hours")) * 3600 + int(clock_match.group("minutes")) * 60 + float(clock_match.group("seconds"))
+        elif null:
+            raise ValueError("Null moves are not supported")
+
+    return MainlineGame(headers, start, moves, cps, mates, depths, clocks)
@@ -0,0 +1,157 @@
+"""
+Compact game records for holding many games in memory.
+
+A parsed `Game` costs kilobytes per ply in nodes, `Move` objects and
+comment strings, and even `MainlineGame` keeps a list entry and a
+`Move` per ply. `PackedGame` keeps the headers as they are and the
+mainline as typed arrays: one 16-bit code per move and parallel arrays
+for evals, eval depths and clocks (in milliseconds), 14 bytes per ply
+in all, which also pickle as flat bytes between processes. Moves are
+decoded again when the game is replayed on a `Board` or turned back
+into a `Game`.
+"""
+
+from array import array
+import chess
+from chess import Board, Move
+from chess.engine import PovScore
+from chess.pgn import Game, GameNode
+from typing import Dict, Iterator, NamedTuple, Optional
+from chesspuzzler.generator.mainline import MainlineGame, MainlineNode, pov_eval
+
+# array slots without a value
+NO_CP = -(2 ** 31)
+NO_MATE = -(2 ** 15)
+NO_DEPTH = -1
+NO_CLOCK = -1
+
+
+def encode_move(move: Move) -> int:
+    """From and to squares in 6 bits each, the promotion piece type above them; 0 is the null move."""
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code: int) -> Move:
+    return Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+
+def pack_clock(seconds: Optional[float]) -> int:
+    return NO_CLOCK if seconds is None else round(seconds * 1000)
+
+
+class PackedGame(NamedTuple):
+    """
+    A game as packed per-ply arrays, in the conventions of `MainlineGame`:
+    evals from white's point of view as `cps` or `mates`. Clocks are
+    kept in milliseconds, so the seconds of a `[%clk]` come back exactly.
+    `fen` is the starting position, None for the standard one.
+    """
+    headers: Dict[str, str]
+    fen: Optional[str]
+    moves: array
+    cps: array
+    mates: array
+    depths: array
+    clocks: array
+
+    @classmethod
+    def from_mainline(cls, mainline: MainlineGame) -> "PackedGame":
+        fen = mainline.board.fen()
+        return cls(
+            mainline.headers,
+            None if fen == chess.STARTING_FEN else fen,
+            array("H", map(encode_move, mainline.moves)),
+            array("i", [NO_CP if cp is None else cp for cp in mainline.cps]),
+            array("h", [NO_MATE if mate is None else mate for mate in mainline.mates]),
+            array("h", [NO_DEPTH if depth is None else depth for depth in mainline.depths]),
+            array("i", map(pack_clock, mainline.clocks)),
+        )
+
+    @classmethod
+    def from_game(cls, game: Game) -> "PackedGame":
+        """Packs the mainline of a parsed game, with the evals and clocks of its comments."""
+        board = game.board()
+        packed = cls(dict(game.headers), None if board.fen() == chess.STARTING_FEN else board.fen(), array("H"), array("i"), array("h"), array("h"), array("i"))
+        for node in game.mainline():
+            score = node.eval()
+            white = score.white() if score is not None else None
+            mate = white.mate() if white is not None else None
+            cp = white.score() if white is not None and mate is None else None
+            depth = node.eval_depth()
+            packed.moves.append(encode_move(node.move))
+            packed.cps.append(NO_CP if cp is None else cp)
+            packed.mates.append(NO_MATE if mate is None else mate)
+            packed.depths.append(NO_DEPTH if depth is None else depth)
+            packed.clocks.append(pack_clock(node.clock()))
+        return packed
+
+    @classmethod
+    def from_board(cls, board: Board, headers: Optional[Dict[str, str]] = None) -> "PackedGame":
+        """Packs the moves played on `board`, which carry no evals or clocks."""
+        root = board.root()
+        plies = len(board.move_stack)
+        return cls(
+            headers or {},
+            None if root.fen() == chess.STARTING_FEN else root.fen(),
+            array("H", map(encode_move, board.move_stack)),
+            array("i", [NO_CP]) * plies,
+            array("h", [NO_MATE]) * plies,
+            array("h", [NO_DEPTH]) * plies,
+            array("i", [NO_CLOCK]) * plies,
+        )
+
+    def board(self) -> Board:
+        """The starting position."""
+        return Board(self.fen) if self.fen else Board()
+
+    def white_starts(self) -> bool:
+        return self.fen is None or self.fen.split()[1] == "w"
+
+    def move(self, ply: int) -> Move:
+        return decode_move(self.moves[ply])
+
+    def eval(self, ply: int) -> Optional[PovScore]:
+        """What `node.eval()` returns for the node reached by `moves[ply]`."""
+        cp, mate = self.cps[ply], self.mates[ply]
+        turn = self.white_starts() if ply % 2 else not self.white_starts()
+        return pov_eval(None if cp == NO_CP else cp, None if mate == NO_MATE else mate, turn)
+
+    def replay(self) -> Iterator[Board]:
+        """
+        Yields the position after each move. It is the same board, pushed
+        in place, so copy it to keep a position.
+        """
+        board = self.board()
+        for code in self.moves:
+            board.push(decode_move(code))
+            yield board
+
+    def end_board(self) -> Board:
+        """The final position, with the moves on its stack."""
+        board = self.board()
+        for code in self.moves:
+            board.push(decode_move(code))
+        return board
+
+    def mainline(self) -> MainlineGame:
+        return MainlineGame(
+            self.headers,
+            self.board(),
+            [decode_move(code) for code in self.moves],
+            [None if cp == NO_CP else cp for cp in self.cps],
+            [None if mate == NO_MATE else mate for mate in self.mates],
+            [None if depth == NO_DEPTH else depth for depth in self.depths],
+            [None if clock == NO_CLOCK else clock / 1000 for clock in self.clocks],
+        )
+
+    def to_game(self) -> Game:
+        game = Game(self.headers)
+        game.setup(self.board())
+        node: GameNode = game
+        # the side to move after each ply, which evals are seen from
+        turn = not self.white_starts()
+        for code, cp, mate, depth, clock in zip(self.moves, self.cps, self.mates, self.depths, self.clocks):
+            score = pov_eval(None if cp == NO_CP else cp, None if mate == NO_MATE else mate, turn)
+            node = MainlineNode(node, decode_move(code), score, None if depth == NO_DEPTH else depth, None if clock == NO_CLOCK else clock / 1000)
+            turn = not turn
+        return game
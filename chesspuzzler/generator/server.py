@@ -1,21 +1,11 @@
 import logging
 from chess.pgn import Game, GameNode, ChildNode
 from model import Puzzle
-import requests
 import urllib.parse
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from chesspuzzler.analysis.http_client import RateLimitedSession
 
-retry_strategy = Retry(
-    total=999999999,
-    backoff_factor=0.1,
-    status_forcelist=[429, 500, 502, 503, 504],
-    method_whitelist=["GET", "POST"]
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
-http = requests.Session()
-http.mount("https://", adapter)
-http.mount("http://", adapter)
+# bounded retries with backoff, waits out 429s; our own server is not rate limited
+http = RateLimitedSession(backoff = 0.1)
 
 TIMEOUT = 5
 
@@ -1,5 +1,4 @@
 from dataclasses import dataclass
-import math
 import chess
 import chess.engine
 from chesspuzzler.generator.model import EngineMove, NextMovePair
@@ -7,6 +6,7 @@ from chess import Color, Board
 from chess.pgn import GameNode
 from chess.engine import SimpleEngine, Score
 from typing import Optional
+from chesspuzzler.analysis.board_util import score_win_chances
 
 nps = []
 
@@ -45,13 +45,7 @@ def win_chances(score: Score) -> float:
     """
     winning chances from -1 to 1 https://graphsketch.com/?eqn1_color=1&eqn1_eqn=100+*+%282+%2F+%281+%2B+exp%28-0.004+*+x%29%29+-+1%29&eqn2_color=2&eqn2_eqn=&eqn3_color=3&eqn3_eqn=&eqn4_color=4&eqn4_eqn=&eqn5_color=5&eqn5_eqn=&eqn6_color=6&eqn6_eqn=&x_min=-1000&x_max=1000&y_min=-100&y_max=100&x_tick=100&y_tick=10&x_label_freq=2&y_label_freq=2&do_grid=0&do_grid=1&bold_labeled_lines=0&bold_labeled_lines=1&line_width=4&image_w=850&image_h=525
     """
-    mate = score.mate()
-    if mate is not None:
-        return 1 if mate > 0 else -1
-
-    cp = score.score()
-    MULTIPLIER = -0.00368208 # https://github.com/lichess-org/lila/pull/11148
-    return 2 / (1 + math.exp(MULTIPLIER * cp)) - 1 if cp is not None else 0
+    return score_win_chances(score.score(), score.mate())
 
 def time_control_tier(line: str) -> Optional[int]:
     if not line.startswith("[TimeControl "):
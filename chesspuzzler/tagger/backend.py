@@ -0,0 +1,191 @@
+import csv
+import json
+import os
+from datetime import datetime
+from itertools import chain
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+from model import TagKind
+
+# puzzle id, tags and the detector versions that produced them
+Result = Tuple[str, List[TagKind], Dict[str, int]]
+Stored = Tuple[List[TagKind], Dict[str, int]]
+
+class Backend:
+    """
+    Where the tagger reads puzzles from and writes their tags to.
+    Puzzles are yielded as docs with `_id`, `fen`, `moves` (or `line`)
+    and `cp`, the shape `tagger.read` expects.
+    """
+
+    def puzzles(self, retag: Optional[Dict[str, int]] = None) -> Iterator[Dict[str, Any]]:
+        # with `retag`, the current detector versions, tagged puzzles whose versions differ are included
+        raise NotImplementedError
+
+    def stored(self, ids: List[str]) -> Dict[str, Stored]:
+        # tags and versions of the puzzles that already have tags
+        raise NotImplementedError
+
+    def write(self, results: List[Result]) -> int:
+        # stores tags, returns how many puzzles changed
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MongoBackend(Backend):
+    """Reads `puzzle2_puzzle` and writes `puzzle2_round`, as lichess does."""
+
+    def __init__(self, batch_size: int) -> None:
+        import pymongo
+        # no connection until first use, so worker processes can fork safely
+        self.client = pymongo.MongoClient(connect = False)
+        db = self.client['puzzler']
+        self.play_coll = db['puzzle2_puzzle']
+        self.round_coll = db['puzzle2_round']
+        self.batch_size = batch_size
+
+    def puzzles(self, retag: Optional[Dict[str, int]] = None) -> Iterator[Dict[str, Any]]:
+        fields = {'fen': True, 'moves': True, 'line': True, 'cp': True}
+        untagged = self.play_coll.find({'themes': []}, fields, batch_size = self.batch_size)
+        if retag is None:
+            return untagged
+        # $ne also matches rounds tagged before a detector existed
+        stale = self.round_coll.aggregate([
+            {'$match': {'_id': {'$regex': '^lichess:'}, '$or': [{f'v.{key}': {'$ne': version}} for key, version in retag.items()]}},
+            {'$lookup': {'from': 'puzzle2_puzzle', 'as': 'puzzle', 'localField': 'p', 'foreignField': '_id'}},
+            {'$unwind': '$puzzle'},
+            {'$replaceRoot': {'newRoot': '$puzzle'}},
+            # untagged ones already come from the first query
+            {'$match': {'themes': {'$ne': []}}},
+            {'$project': fields},
+        ], batchSize = self.batch_size)
+        return chain(untagged, stale)
+
+    def rounds(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        return {
+            doc['_id'][len("lichess:"):]: doc
+            for doc in self.round_coll.find({"_id": {"$in": [f"lichess:{id}" for id in ids]}}, {"t": True, "v": True})
+        }
+
+    def stored(self, ids: List[str]) -> Dict[str, Stored]:
+        return {
+            id: ([t[1:] for t in doc['t'] if t not in ['+zugzwang', '-zugzwang']], doc.get('v', {}))
+            for id, doc in self.rounds(ids).items() if len(doc.get('t', [])) > 1
+        }
+
+    def write(self, results: List[Result]) -> int:
+        from pymongo import UpdateOne
+        existing = self.rounds([id for id, _, _ in results])
+        round_writes = []
+        play_writes = []
+        for id, tags, versions in results:
+            old_tags = existing.get(id, {}).get('t', [])
+            zugs = [t for t in old_tags if t in ['+zugzwang', '-zugzwang']]
+            new_tags = [f"+{t}" for t in tags] + zugs
+            if id not in existing or set(new_tags) != set(old_tags):
+                round_writes.append(UpdateOne({
+                    "_id": f"lichess:{id}"
+                }, {
+                    "$set": {
+                        "p": id,
+                        "d": datetime.now(),
+                        "e": 100,
+                        "t": new_tags,
+                        "v": versions
+                    }
+                }, upsert = True))
+                play_writes.append(UpdateOne({"_id": id}, {"$set": {"dirty": True}}))
+            elif existing[id].get('v') != versions:
+                round_writes.append(UpdateOne({"_id": f"lichess:{id}"}, {"$set": {"v": versions}}))
+        if round_writes:
+            self.round_coll.bulk_write(round_writes, ordered = False)
+        if play_writes:
+            self.play_coll.bulk_write(play_writes, ordered = False)
+        return len(play_writes)
+
+    def close(self) -> None:
+        self.client.close()
+
+
+class FileBackend(Backend):
+    """
+    Streams puzzles from a JSONL or CSV file and appends tags to another.
+
+    CSV input follows the lichess puzzle export (`PuzzleId`, `FEN`,
+    `Moves`, ...) with an optional `Cp` column; JSONL input takes the
+    generator's puzzle json (`fen`, `moves`, `cp`) with an `_id` or `id`,
+    falling back to the line number. The output is JSONL
+    (`{"_id": ..., "themes": [...], "versions": {...}}`) or, for a `.csv`
+    path, `PuzzleId,Themes,Versions`. It is only appended to, the last line
+    of a puzzle wins, and ids already in it are skipped so an interrupted
+    run resumes. It is opened, or truncated with `overwrite`, on the first
+    write, so a dry run leaves it as it is.
+    """
+
+    def __init__(self, input_path: str, output_path: str, overwrite: bool = False) -> None:
+        self.input_path = input_path
+        self.output_path = output_path
+        self.csv_output = output_path.endswith(".csv")
+        self.overwrite = overwrite
+        self.done: Dict[str, Stored] = {} if overwrite else dict(self.read_output())
+        self.output: Optional[TextIO] = None
+
+    def open_output(self) -> TextIO:
+        new_file = self.overwrite or not os.path.exists(self.output_path)
+        self.output = open(self.output_path, "w" if self.overwrite else "a", newline = "")
+        if self.csv_output:
+            self.writer = csv.writer(self.output)
+            if new_file:
+                self.writer.writerow(["PuzzleId", "Themes", "Versions"])
+        return self.output
+
+    def read_output(self) -> Iterator[Tuple[str, Stored]]:
+        if not os.path.exists(self.output_path):
+            return
+        with open(self.output_path, newline = "") as file:
+            if self.csv_output:
+                for row in csv.DictReader(file):
+                    yield row["PuzzleId"], (row["Themes"].split(), json.loads(row.get("Versions") or "{}"))
+            else:
+                for line in file:
+                    if line.strip():
+                        doc = json.loads(line)
+                        yield doc["_id"], (doc["themes"], doc.get("versions", {}))
+
+    def puzzles(self, retag: Optional[Dict[str, int]] = None) -> Iterator[Dict[str, Any]]:
+        # every puzzle of the input is yielded, `pending` picks the stale ones
+        with open(self.input_path, newline = "") as file:
+            if self.input_path.endswith(".csv"):
+                for row in csv.DictReader(file):
+                    yield {
+                        "_id": row["PuzzleId"],
+                        "fen": row["FEN"],
+                        "moves": row["Moves"].split(),
+                        "cp": row.get("Cp") or 0,
+                    }
+            else:
+                for number, line in enumerate(file):
+                    if not line.strip():
+                        continue
+                    doc = json.loads(line)
+                    doc["_id"] = str(doc.get("_id", doc.get("id", number)))
+                    yield doc
+
+    def stored(self, ids: List[str]) -> Dict[str, Stored]:
+        return {id: self.done[id] for id in ids if id in self.done}
+
+    def write(self, results: List[Result]) -> int:
+        output = self.output or self.open_output()
+        for id, tags, versions in results:
+            if self.csv_output:
+                self.writer.writerow([id, " ".join(tags), json.dumps(versions)])
+            else:
+                output.write(json.dumps({"_id": id, "themes": tags, "versions": versions}) + "\n")
+            self.done[id] = (tags, versions)
+        output.flush()
+        return len(results)
+
+    def close(self) -> None:
+        if self.output:
+            self.output.close()
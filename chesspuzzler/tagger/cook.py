@@ -1,11 +1,15 @@
 import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+import time
 
-from typing import List, Optional, Union
+from typing import Callable, Collection, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
 import chess
 from chess import square_rank, square_file, Board, SquareSet, Piece, PieceType, square_distance
 from chess import KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN
 from chess import WHITE, BLACK
-from chess.pgn import ChildNode
+from chess.pgn import ChildNode, Game
 from chesspuzzler.tagger.model import Puzzle, TagKind
 from chesspuzzler.tagger import util
 from chesspuzzler.tagger.util import material_diff
@@ -16,12 +20,206 @@ from chesspuzzler.tagger.model import Puzzle as TagPuzzle
 logger = configure_log(__name__, "puzzle_tagger.log")
 
 
-def cook(puzzle: GenPuzzle) -> List[TagKind]:
+class LineFacts:
+    """
+    Cheap structural facts about the solution line, gathered with a
+    single board replay. Detector preconditions are written against
+    these so that a detector is only run when it could possibly fire.
+    """
+    def __init__(self, puzzle: Puzzle):
+        board = puzzle.game.board()
+        self.length = len(puzzle.mainline)
+        self.start_check = board.is_check()
+        self.captures: List[bool] = []
+        self.checks: List[bool] = []
+        self.promotions: List[bool] = []
+        self.to_squares: List[chess.Square] = []
+        for node in puzzle.mainline:
+            self.captures.append(board.is_capture(node.move))
+            self.promotions.append(bool(node.move.promotion))
+            self.to_squares.append(node.move.to_square)
+            board.push(node.move)
+            self.checks.append(board.is_check())
+        self.mate = board.is_checkmate()
+
+    def any_at(self, flags: List[bool], start: int, stop: Optional[int] = None) -> bool:
+        # every other ply from `start`, e.g. 1 for the nodes of `puzzle.mainline[1::2]`
+        return any(flags[start:stop:2])
+
+    def late_capture(self) -> bool:
+        # a capture in `puzzle.mainline[1::2][1:]`
+        return self.any_at(self.captures, 3)
+
+    def recapture_on_moved_square(self) -> bool:
+        # a node of `puzzle.mainline[1::2][1:]` lands on the square the previous move went to
+        return any(
+            self.to_squares[i] == self.to_squares[i - 1]
+            for i in range(3, self.length - 1, 2)
+        )
+
+    def check_before_reply(self) -> bool:
+        # the position before a node of `puzzle.mainline[1::2]` is check
+        return self.any_at(self.checks, 0, self.length - 1)
+
+    def quiet_candidate(self) -> bool:
+        # an even ply, not the last, that neither checks, escapes check nor captures
+        for i in range(0, self.length - 1, 2):
+            escaped = self.checks[i - 1] if i else self.start_check
+            if not self.checks[i] and not escaped and not self.captures[i]:
+                return True
+        return False
+
+    def f2_f7_capture(self) -> bool:
+        return any(
+            self.captures[i] and self.to_squares[i] in [chess.F2, chess.F7]
+            for i in range(1, self.length, 2)
+        )
+
+
+class Detector(NamedTuple):
+    tag: TagKind
+    test: Callable[[Puzzle], bool]
+    # when False the test is known to return False and is not run
+    precondition: Callable[[LineFacts], bool]
+    # mean seconds per puzzle, see `measure_detector_costs`
+    cost: float
+    # the tag is not given if any of these tags were given
+    unless: Tuple[TagKind, ...] = ()
+    # bump when the test changes, puzzles tagged by an older version are re-tagged
+    version: int = 1
+
+
+def always(facts: LineFacts) -> bool:
+    return True
+
+# Versions of the parts of `cook` that are not in `DETECTORS`: the mate
+# patterns with the advantage band, and the line length.
+SECTION_VERSIONS: Dict[str, int] = {
+    "outcome": 1,
+    "length": 1,
+}
+
+OUTCOME_TAGS = {
+    "mate", "mateIn1", "mateIn2", "mateIn3", "mateIn4", "mateIn5",
+    "smotheredMate", "backRankMate", "anastasiaMate", "hookMate", "arabianMate",
+    "bodenMate", "doubleBishopMate", "dovetailMate",
+    "crushing", "advantage", "equality",
+}
+
+LENGTH_TAGS = {"oneMove", "short", "long", "veryLong"}
+
+def owner(tag: str) -> str:
+    # the key under which the version of whatever produces `tag` is stored
+    if tag in OUTCOME_TAGS:
+        return "outcome"
+    if tag in LENGTH_TAGS:
+        return "length"
+    return tag
+
+def detector_versions() -> Dict[str, int]:
+    versions = dict(SECTION_VERSIONS)
+    for detector in DETECTORS:
+        versions[detector.tag] = max(detector.version, versions.get(detector.tag, 0))
+    return versions
+
+def stale_detectors(versions: Dict[str, int]) -> Set[str]:
+    """
+    Keys of `detector_versions` whose stored version differs, plus the
+    detectors whose `unless` depends on one of them.
+    """
+    stale = {key for key, version in detector_versions().items() if versions.get(key) != version}
+    changed = True
+    while changed:
+        changed = False
+        for detector in DETECTORS:
+            if detector.tag not in stale and any(owner(tag) in stale for tag in detector.unless):
+                stale.add(detector.tag)
+                changed = True
+    return stale
+
+
+def run_detectors(puzzle: Puzzle, facts: LineFacts, given: List[TagKind], stale: Optional[Set[str]] = None, previous: Collection[TagKind] = ()) -> List[TagKind]:
+    """
+    Runs `DETECTORS` cheapest tag first, skipping tests whose precondition
+    is false, and returns the tags found in `DETECTORS` order. Tags in `given`
+    (the mate patterns) can suppress detectors through `unless`. When
+    `stale` is set, only those detectors run and the others are taken
+    from `previous`.
+    """
+    fired: Dict[TagKind, bool] = {tag: True for tag in given}
+    pending: Dict[TagKind, List[Detector]] = {}
+    for detector in DETECTORS:
+        pending.setdefault(detector.tag, []).append(detector)
+
+    def resolve(tag: TagKind) -> bool:
+        if tag in fired:
+            return fired[tag]
+        if tag not in pending:
+            return False
+        if stale is not None and tag not in stale:
+            pending.pop(tag)
+            fired[tag] = tag in previous
+            return fired[tag]
+        fired[tag] = False
+        detectors = pending.pop(tag)
+        if any(resolve(other) for other in detectors[0].unless):
+            return False
+        fired[tag] = any(d.precondition(facts) and d.test(puzzle) for d in detectors)
+        return fired[tag]
+
+    for detector in sorted(DETECTORS, key=lambda d: d.cost):
+        resolve(detector.tag)
+
+    tags: List[TagKind] = []
+    for detector in DETECTORS:
+        if fired.get(detector.tag) and detector.tag not in tags:
+            tags.append(detector.tag)
+    return tags
+
+
+def measure_detector_costs(puzzles: List[GenPuzzle]) -> Dict[str, float]:
+    """
+    Mean seconds per puzzle spent in each detector test, run
+    unconditionally. Used to refresh the `cost` column of `DETECTORS`.
+    """
+    totals = [0.0] * len(DETECTORS)
+    count = 0
+    for gen_puzzle in puzzles:
+        puzzle = TagPuzzle(gen_puzzle.node, gen_puzzle.moves, gen_puzzle.cp)
+        count += 1
+        for i, detector in enumerate(DETECTORS):
+            start = time.perf_counter()
+            try:
+                detector.test(puzzle)
+            except Exception:
+                pass
+            totals[i] += time.perf_counter() - start
+    return {
+        f"{i} {detector.tag}": totals[i] / max(count, 1)
+        for i, detector in enumerate(DETECTORS)
+    }
+
+
+def recook(puzzle: GenPuzzle, previous: List[TagKind], versions: Dict[str, int]) -> List[TagKind]:
+    """
+    Re-tags a puzzle whose `previous` tags were produced by `versions`,
+    only running the detectors that changed since.
+    """
+    return cook(puzzle, stale_detectors(versions), previous)
+
+
+def cook(puzzle: GenPuzzle, stale: Optional[Set[str]] = None, previous: Collection[TagKind] = ()) -> List[TagKind]:
     puzzle = TagPuzzle(puzzle.node, puzzle.moves, puzzle.cp)
+    facts = LineFacts(puzzle)
     tags : List[TagKind] = []
 
-    mate_tag = mate_in(puzzle)
-    if mate_tag:
+    def fresh(key: str) -> bool:
+        return stale is None or key in stale
+
+    mate_tag = mate_in(puzzle) if facts.mate else None
+    if not fresh("outcome"):
+        tags += [tag for tag in previous if tag in OUTCOME_TAGS]
+    elif mate_tag:
         tags.append(mate_tag)
         tags.append("mate")
         if smothered_mate(puzzle):
@@ -47,100 +245,11 @@ def cook(puzzle: GenPuzzle) -> List[TagKind]:
     else:
         tags.append("equality")
 
-    if attraction(puzzle):
-        tags.append("attraction")
-
-    if deflection(puzzle):
-        tags.append("deflection")
-    elif overloading(puzzle):
-        tags.append("overloading")
-
-    if advanced_pawn(puzzle):
-        tags.append("advancedPawn")
-
-    if double_check(puzzle):
-        tags.append("doubleCheck")
+    tags += run_detectors(puzzle, facts, tags, stale, previous)
 
-    if quiet_move(puzzle):
-        tags.append("quietMove")
-
-    if defensive_move(puzzle) or check_escape(puzzle):
-        tags.append("defensiveMove")
-
-    if sacrifice(puzzle):
-        tags.append("sacrifice")
-
-    if x_ray(puzzle):
-        tags.append("xRayAttack")
-
-    if fork(puzzle):
-        tags.append("fork")
-
-    if hanging_piece(puzzle):
-        tags.append("hangingPiece")
-
-    if trapped_piece(puzzle):
-        tags.append("trappedPiece")
-
-    if discovered_attack(puzzle):
-        tags.append("discoveredAttack")
-
-    if exposed_king(puzzle):
-        tags.append("exposedKing")
-
-    if skewer(puzzle):
-        tags.append("skewer")
-
-    if self_interference(puzzle) or interference(puzzle):
-        tags.append("interference")
-
-    if intermezzo(puzzle):
-        tags.append("intermezzo")
-
-    if pin_prevents_attack(puzzle) or pin_prevents_escape(puzzle):
-        tags.append("pin")
-
-    if attacking_f2_f7(puzzle):
-        tags.append("attackingF2F7")
-
-    if clearance(puzzle):
-        tags.append("clearance")
-
-    if en_passant(puzzle):
-        tags.append("enPassant")
-
-    if castling(puzzle):
-        tags.append("castling")
-
-    if promotion(puzzle):
-        tags.append("promotion")
-    
-    if under_promotion(puzzle):
-            tags.append("underPromotion")
-
-    if capturing_defender(puzzle):
-        tags.append("capturingDefender")
-
-    if piece_endgame(puzzle, PAWN):
-        tags.append("pawnEndgame")
-    elif piece_endgame(puzzle, QUEEN):
-        tags.append("queenEndgame")
-    elif piece_endgame(puzzle, ROOK):
-        tags.append("rookEndgame")
-    elif piece_endgame(puzzle, BISHOP):
-        tags.append("bishopEndgame")
-    elif piece_endgame(puzzle, KNIGHT):
-        tags.append("knightEndgame")
-    elif queen_rook_endgame(puzzle):
-        tags.append("queenRookEndgame")
-
-    if "backRankMate" not in tags and "fork" not in tags:
-        if kingside_attack(puzzle):
-            tags.append("kingsideAttack")
-        elif queenside_attack(puzzle):
-            tags.append("queensideAttack")
-
-    if len(puzzle.mainline) == 2:
+    if not fresh("length"):
+        tags += [tag for tag in previous if tag in LENGTH_TAGS]
+    elif len(puzzle.mainline) == 2:
         tags.append("oneMove")
     elif len(puzzle.mainline) == 4:
         tags.append("short")
@@ -151,6 +260,51 @@ def cook(puzzle: GenPuzzle) -> List[TagKind]:
 
     return tags
 
+class PuzzleDescriptor(NamedTuple):
+    """
+    What a worker process needs to tag a puzzle: the position after the
+    blunder, the solution in UCI and the score. Cheap to pickle, unlike a
+    node that drags its whole game along.
+    """
+    fen: str
+    moves: List[str]
+    cp: int
+
+
+def describe(puzzle: GenPuzzle) -> PuzzleDescriptor:
+    return PuzzleDescriptor(puzzle.node.board().fen(), [move.uci() for move in puzzle.moves], puzzle.cp)
+
+
+def cook_descriptor(descriptor: PuzzleDescriptor) -> List[TagKind]:
+    # detectors never look above the puzzle position, so a bare game rooted
+    # there tags the same as the original node and is cheap to copy
+    node = Game.from_board(Board(descriptor.fen))
+    moves = [chess.Move.from_uci(uci) for uci in descriptor.moves]
+    return cook(GenPuzzle(node, moves, descriptor.cp))
+
+
+# fewer puzzles than this are tagged in this process, a pool would cost more than it saves
+MIN_POOL_BATCH = 32
+
+
+def cook_many(puzzles: Iterable[GenPuzzle], workers: Optional[int] = None, pool: Optional[multiprocessing.pool.Pool] = None) -> List[List[TagKind]]:
+    """
+    Tags `puzzles` on `pool`, or on a pool of `workers` processes (all
+    cores by default) made for the call, and returns their tags in the
+    same order. Callers tagging batch after batch should pass one
+    long-lived pool. Below `MIN_POOL_BATCH` puzzles they are tagged
+    serially. The first puzzle that fails to cook raises.
+    """
+    descriptors = [describe(puzzle) for puzzle in puzzles]
+    workers = min(workers or os.cpu_count() or 1, len(descriptors))
+    if workers <= 1 or len(descriptors) < MIN_POOL_BATCH:
+        return [cook_descriptor(descriptor) for descriptor in descriptors]
+    chunksize = max(1, len(descriptors) // (workers * 4))
+    if pool is not None:
+        return pool.map(cook_descriptor, descriptors, chunksize)
+    with multiprocessing.Pool(workers) as pool:
+        return pool.map(cook_descriptor, descriptors, chunksize)
+
 def advanced_pawn(puzzle: Puzzle) -> bool:
     for node in puzzle.mainline[1::2]:
         if util.is_very_advanced_pawn_move(node):
@@ -791,3 +945,45 @@ def mate_in(puzzle: Puzzle) -> Optional[TagKind]:
     elif moves_to_mate == 4:
         return "mateIn4"
     return "mateIn5"
+
+# Listed in the order tags are emitted. A tag listed several times is
+# given if any of its tests pass, tried in listed order since a later
+# test may raise on lines an earlier one accepts (see pin_prevents_attack).
+DETECTORS: List[Detector] = [
+    Detector("attraction", attraction, LineFacts.recapture_on_moved_square, 0.00020),
+    Detector("deflection", deflection, lambda f: f.late_capture() or f.any_at(f.promotions, 3), 0.00133),
+    Detector("overloading", overloading, lambda f: False, 0.0, ("deflection",)),
+    Detector("advancedPawn", advanced_pawn, always, 0.00112),
+    Detector("doubleCheck", double_check, lambda f: f.any_at(f.checks, 1), 0.00113),
+    Detector("quietMove", quiet_move, LineFacts.quiet_candidate, 0.00324),
+    Detector("defensiveMove", defensive_move, lambda f: not f.checks[-1] and not f.captures[-1], 0.00177),
+    Detector("defensiveMove", check_escape, LineFacts.check_before_reply, 0.00175),
+    Detector("sacrifice", sacrifice, lambda f: any(f.captures) or any(f.promotions), 0.00252),
+    Detector("xRayAttack", x_ray, LineFacts.late_capture, 0.00075),
+    Detector("fork", fork, lambda f: f.length > 3, 0.00118),
+    Detector("hangingPiece", hanging_piece, lambda f: f.captures[1], 0.00106),
+    Detector("trappedPiece", trapped_piece, LineFacts.late_capture, 0.00079),
+    Detector("discoveredAttack", discovered_attack, lambda f: f.any_at(f.checks, 1) or f.late_capture(), 0.00183),
+    Detector("exposedKing", exposed_king, lambda f: f.any_at(f.checks, 3, f.length - 1), 0.00075),
+    Detector("skewer", skewer, LineFacts.late_capture, 0.00095),
+    Detector("interference", self_interference, LineFacts.late_capture, 0.00086),
+    Detector("interference", interference, LineFacts.late_capture, 0.00074),
+    Detector("intermezzo", intermezzo, LineFacts.late_capture, 0.00073),
+    Detector("pin", pin_prevents_attack, always, 0.00129),
+    Detector("pin", pin_prevents_escape, always, 0.00129),
+    Detector("attackingF2F7", attacking_f2_f7, LineFacts.f2_f7_capture, 0.00112),
+    Detector("clearance", clearance, lambda f: f.length > 3, 0.00152),
+    Detector("enPassant", en_passant, lambda f: f.any_at(f.captures, 1), 0.00117),
+    Detector("castling", castling, always, 0.00111),
+    Detector("promotion", promotion, lambda f: f.any_at(f.promotions, 1), 0.00001),
+    Detector("underPromotion", under_promotion, lambda f: f.any_at(f.promotions, 1), 0.00113),
+    Detector("capturingDefender", capturing_defender, lambda f: f.late_capture() or f.any_at(f.checks, 3), 0.00185),
+    Detector("pawnEndgame", lambda p: piece_endgame(p, PAWN), always, 0.00093),
+    Detector("queenEndgame", lambda p: piece_endgame(p, QUEEN), always, 0.00087, ("pawnEndgame",)),
+    Detector("rookEndgame", lambda p: piece_endgame(p, ROOK), always, 0.00088, ("pawnEndgame", "queenEndgame")),
+    Detector("bishopEndgame", lambda p: piece_endgame(p, BISHOP), always, 0.00089, ("pawnEndgame", "queenEndgame", "rookEndgame")),
+    Detector("knightEndgame", lambda p: piece_endgame(p, KNIGHT), always, 0.00088, ("pawnEndgame", "queenEndgame", "rookEndgame", "bishopEndgame")),
+    Detector("queenRookEndgame", queen_rook_endgame, always, 0.00046, ("pawnEndgame", "queenEndgame", "rookEndgame", "bishopEndgame", "knightEndgame")),
+    Detector("kingsideAttack", kingside_attack, lambda f: f.any_at(f.checks, 1), 0.00044, ("backRankMate", "fork")),
+    Detector("queensideAttack", queenside_attack, lambda f: f.any_at(f.checks, 1), 0.00043, ("backRankMate", "fork", "kingsideAttack")),
+]
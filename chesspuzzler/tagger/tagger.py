@@ -1,13 +1,17 @@
 import pymongo
 import logging
 import argparse
-from multiprocessing import Process, Queue, Pool, Manager
+import zlib
+from itertools import islice
+from multiprocessing import Process, Queue
+from queue import Full
 from datetime import datetime
 from chess import Move, Board
-from chess.pgn import Game, GameNode
+from chess.pgn import Game, GameNode, ChildNode
 from chess.engine import SimpleEngine, Mate, Cp
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Callable, Iterable, Iterator, Optional
 from model import Puzzle, TagKind
+from backend import Backend, MongoBackend, FileBackend, Result
 import cook
 import chess.engine
 from zugzwang import zugzwang
@@ -18,130 +22,226 @@ logger.setLevel(logging.INFO)
 
 def read(doc) -> Puzzle:
     board = Board(doc["fen"])
-    node: GameNode = Game.from_board(board)
-    for uci in (doc["line"].split(' ') if "line" in doc else doc["moves"]):
-        move = Move.from_uci(uci)
-        node = node.add_main_variation(move)
-    return Puzzle(doc["_id"], node.game(), int(doc["cp"]))
+    moves = [Move.from_uci(uci) for uci in (doc["line"].split(' ') if "line" in doc else doc["moves"])]
+    # the first move is the opponent's, the puzzle starts from the position it leads to
+    node: ChildNode = Game.from_board(board).add_main_variation(moves[0])
+    return Puzzle(node, moves[1:], int(doc["cp"]))
+
+# node limits of the --bad_mate search, tried in turn with --escalate
+bad_mate_nodes = [1_000_000, 5_000_000, 30_000_000]
+# alternatives this close to the Cp(250) cutoff get searched with more nodes
+bad_mate_margin = 100
+
+def bad_mate(engine: SimpleEngine, puzzle: Puzzle, escalate: bool = False) -> Tuple[bool, int]:
+    """
+    Whether the mate has a non mate-in-one alternative that is still
+    winning by more than Cp(250), and the node limit that decided it.
+    """
+    board = puzzle.mainline[len(puzzle.mainline) - 2].board()
+    for nodes in (bad_mate_nodes if escalate else bad_mate_nodes[-1:]):
+        info = engine.analyse(board, multipv = 5, limit = chess.engine.Limit(nodes = nodes))
+        alternatives = [score for score in [pv["score"].pov(puzzle.pov) for pv in info] if score < Mate(1)]
+        bad = any(score > Cp(250) for score in alternatives)
+        if not any(score.score() is not None and abs(score.score() - 250) <= bad_mate_margin for score in alternatives):
+            break
+    return bad, nodes
+
+def shard_of(id: str, shards: int) -> int:
+    # crc32 spreads lichess ids evenly, unlike any single character of them
+    return zlib.crc32(id.encode()) % shards
+
+def chunks(docs: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    docs = iter(docs)
+    while True:
+        chunk = list(islice(docs, size))
+        if not chunk:
+            return
+        yield chunk
+
+Batches = Iterator[List[Dict[str, Any]]]
+# computed and updated counts, plus results for the reader to `collect`
+Report = Callable[..., None]
+
+def work_loop(thread_id: int, cruncher: Callable[[int, Batches, Report], None], tasks: Queue, progress: Queue) -> None:
+    def report(computed: int, updated: int, results: Optional[List[Result]] = None) -> None:
+        progress.put((thread_id, computed, updated, results))
+    cruncher(thread_id, iter(tasks.get, None), report)
+
+def distribute(source: Callable[[], Iterable[Dict[str, Any]]], cruncher: Callable[[int, Batches, Report], None], threads: int, batch_size: int, shard: int = 0, shards: int = 1, collect: Optional[Callable[[List[Result]], int]] = None) -> None:
+    """
+    Reads the docs of `source()` once, in this process, and hands batches
+    of them to `threads` cruncher processes through a bounded queue, so
+    workers never scan the collection themselves and idle ones pick up
+    the next batch. Only docs whose id falls in `shard` out of `shards` are kept,
+    which lets several hosts split the crunching of a run; the shard is
+    picked from the docs read, so every host still reads them all. Results reported by the
+    workers are passed to `collect` here, which makes this process the
+    single writer, and its return value is counted as updated.
+    """
+    tasks: Queue = Queue(maxsize = threads * 2)
+    progress: Queue = Queue()
+    workers = [Process(target=work_loop, args=(i, cruncher, tasks, progress)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    counts = {i: [0, 0] for i in range(threads)}
+
+    def log_progress() -> None:
+        while not progress.empty():
+            thread_id, computed, updated, results = progress.get()
+            if results and collect:
+                updated += collect(results)
+            counts[thread_id][0] += computed
+            counts[thread_id][1] += updated
+            logger.info(f'worker {thread_id}: {counts[thread_id][0]} / {counts[thread_id][1]}')
+
+    def put(task: Optional[List[Dict[str, Any]]]) -> None:
+        while True:
+            try:
+                tasks.put(task, timeout = 1)
+                return
+            except Full:
+                log_progress()
+                if any(w.exitcode not in (None, 0) for w in workers):
+                    raise RuntimeError("a cruncher died, aborting")
+
+    read = 0
+    try:
+        # the source opens its own client, after the workers have forked
+        docs = source()
+        for batch in chunks((doc for doc in docs if shard_of(doc["_id"], shards) == shard), batch_size):
+            put(batch)
+            read += len(batch)
+            log_progress()
+        for _ in workers:
+            put(None)
+        for worker in workers:
+            # keep draining progress, a worker cannot exit with it unread
+            while worker.is_alive():
+                log_progress()
+                worker.join(timeout = 1)
+        if any(worker.exitcode for worker in workers):
+            raise RuntimeError("a cruncher failed")
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        raise
+    log_progress()
+    logger.info(f'{read} read / {sum(c[0] for c in counts.values())} / {sum(c[1] for c in counts.values())}')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='tagger.py', description='automatically tags lichess puzzles')
     parser.add_argument("--zug", "-z", help="only zugzwang", action="store_true")
+    parser.add_argument("--escalate", help="with --zug or --bad_mate, search shallow first and deep only when close to the cutoff", action="store_true")
     parser.add_argument("--bad_mate", help="find bad mates", action="store_true")
     parser.add_argument("--dry", "-d", help="dry run", action="store_true")
     parser.add_argument("--all", "-a", help="don't skip existing", action="store_true")
-    parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
+    parser.add_argument("--retag", "-r", help="re-run detectors whose version changed on existing", action="store_true")
+    parser.add_argument("--threads", "-t", help="count of cruncher processes", default="4")
     parser.add_argument("--engine", "-e", help="analysis engine", default="stockfish")
+    parser.add_argument("--batch", "-b", help="puzzles per cursor batch and bulk write", default="1000")
+    parser.add_argument("--input", "-i", help="tag a puzzle file (.jsonl or lichess .csv) instead of the database")
+    parser.add_argument("--output", "-o", help="where to write tags of --input, .jsonl or .csv", default=None)
+    parser.add_argument("--shard", "-s", help="only process ids in shard i of n, as i/n; each host still reads the full collection and keeps its shard", default="0/1")
     args = parser.parse_args()
 
+    threads = int(args.threads)
+    batch_size = int(args.batch)
+    shard, shards = map(int, args.shard.split('/'))
+
     if args.zug:
-        threads = int(args.threads)
-        def cruncher(thread_id: int):
+        def cruncher(thread_id: int, batches: Batches, report: Report):
             db = pymongo.MongoClient()['puzzler']
             round_coll = db['puzzle2_round']
             play_coll = db['puzzle2_puzzle']
             engine = SimpleEngine.popen_uci(args.engine)
             engine.configure({'Threads': 2})
-            for doc in round_coll.aggregate([
-                {"$match":{"_id":{"$regex":"^lichess:"},"t":{"$nin":['+zugzwang','-zugzwang']}}},
-                {'$lookup':{'from':'puzzle2_puzzle','as':'puzzle','localField':'p','foreignField':'_id'}},
-                {'$unwind':'$puzzle'},{'$replaceRoot':{'newRoot':'$puzzle'}}
-            ]):
-                try:
-                    if ord(doc["_id"][4]) % threads != thread_id:
-                        continue
-                    puzzle = read(doc)
-                    round_id = f'lichess:{puzzle.id}'
-                    zug = zugzwang(engine, puzzle)
-                    if zug:
-                        cook.log(puzzle)
-                    round_coll.update_one(
-                        { "_id": round_id }, 
-                        {"$addToSet": {"t": "+zugzwang" if zug else "-zugzwang"}}
-                    )
-                    play_coll.update_one({"_id":puzzle.id},{"$set":{"dirty":True}})
-                except Exception as e:
-                    print(doc)
-                    logger.error(e)
-                    engine.close()
-                    exit(1)
+            for docs in batches:
+                updated = 0
+                for doc in docs:
+                    try:
+                        puzzle = read(doc)
+                        round_id = f'lichess:{doc["_id"]}'
+                        zug = zugzwang(engine, puzzle, args.escalate)
+                        if zug:
+                            updated += 1
+                            logger.info(f'zugzwang {doc["_id"]}')
+                        round_coll.update_one(
+                            { "_id": round_id }, 
+                            {"$addToSet": {"t": "+zugzwang" if zug else "-zugzwang"}}
+                        )
+                        play_coll.update_one({"_id":doc["_id"]},{"$set":{"dirty":True}})
+                    except Exception as e:
+                        print(doc)
+                        logger.error(e)
+                        engine.close()
+                        exit(1)
+                report(len(docs), updated)
             engine.close()
-        with Pool(processes=threads) as pool:
-            for i in range(int(args.threads)):
-                Process(target=cruncher, args=(i,)).start()
+        distribute(lambda: pymongo.MongoClient()['puzzler']['puzzle2_round'].aggregate([
+            {"$match":{"_id":{"$regex":"^lichess:"},"t":{"$nin":['+zugzwang','-zugzwang']}}},
+            {'$lookup':{'from':'puzzle2_puzzle','as':'puzzle','localField':'p','foreignField':'_id'}},
+            {'$unwind':'$puzzle'},{'$replaceRoot':{'newRoot':'$puzzle'}}
+        ]), cruncher, threads, batch_size, shard, shards)
         exit(0)
 
     if args.bad_mate:
-        threads = int(args.threads)
-        def cruncher(thread_id: int):
+        def cruncher(thread_id: int, batches: Batches, report: Report):
             db = pymongo.MongoClient()['puzzler']
             bad_coll = db['puzzle2_bad_maybe']
             play_coll = db['puzzle2_puzzle']
             engine = SimpleEngine.popen_uci('./stockfish')
             engine.configure({'Threads': 4})
-            for doc in bad_coll.find({"bad": {"$exists":False}}):
-                try:
-                    if ord(doc["_id"][4]) % threads != thread_id:
-                        continue
-                    doc = play_coll.find_one({'_id': doc['_id']})
-                    if not doc:
-                        continue
-                    puzzle = read(doc)
-                    board = puzzle.mainline[len(puzzle.mainline) - 2].board()
-                    info = engine.analyse(board, multipv = 5, limit = chess.engine.Limit(nodes = 30_000_000))
-                    bad = False
-                    for score in [pv["score"].pov(puzzle.pov) for pv in info]:
-                        if score < Mate(1) and score > Cp(250):
-                            bad = True
-                    # logger.info(puzzle.id)
-                    bad_coll.update_one({"_id":puzzle.id},{"$set":{"bad":bad}})
-                except Exception as e:
-                    logger.error(e)
-        with Pool(processes=threads) as pool:
-            for i in range(int(args.threads)):
-                Process(target=cruncher, args=(i,)).start()
+            for docs in batches:
+                updated = 0
+                for doc in docs:
+                    try:
+                        doc = play_coll.find_one({'_id': doc['_id']})
+                        if not doc:
+                            continue
+                        bad, nodes = bad_mate(engine, read(doc), args.escalate)
+                        updated += bad
+                        bad_coll.update_one({"_id":doc["_id"]},{"$set":{"bad":bad,"nodes":nodes}})
+                    except Exception as e:
+                        logger.error(e)
+                report(len(docs), updated)
+            engine.close()
+        distribute(lambda: pymongo.MongoClient()['puzzler']['puzzle2_bad_maybe'].find({"bad": {"$exists":False}}, {"_id": True}), cruncher, threads, batch_size, shard, shards)
         exit(0)
 
-    threads = int(args.threads)
+    backend: Backend = (
+        FileBackend(args.input, args.output or f"{args.input}.tags.jsonl", overwrite = args.all)
+        if args.input else MongoBackend(batch_size)
+    )
+
+    versions = cook.detector_versions()
+
+    def pending() -> Iterator[Dict[str, Any]]:
+        for docs in chunks(backend.puzzles(versions if args.retag else None), batch_size):
+            stored = {} if args.all else backend.stored([doc["_id"] for doc in docs])
+            for doc in docs:
+                if doc["_id"] not in stored:
+                    yield doc
+                elif args.retag and cook.stale_detectors(stored[doc["_id"]][1]):
+                    doc["previous"], doc["versions"] = stored[doc["_id"]]
+                    yield doc
 
-    def cruncher(thread_id: int):
-        db = pymongo.MongoClient()['puzzler']
-        play_coll = db['puzzle2_puzzle']
-        round_coll = db['puzzle2_round']
-        total = 0
-        computed = 0
-        updated = 0
-        for doc in play_coll.find({'themes':[]}):
-            total += 1
-            if not thread_id and total % 1000 == 0:
-                logger.info(f'{total} / {computed} / {updated}')
-            if ord(doc["_id"][4]) % threads != thread_id:
-                continue
-            computed += 1
-            id = doc["_id"]
-            if not args.all and round_coll.count_documents({"_id": f"lichess:{id}", "t.1": {"$exists":True}}):
-                continue
-            tags = cook.cook(read(doc))
-            round_id = f"lichess:{id}"
-            if not args.dry:
-                existing = round_coll.find_one({"_id": round_id},{"t":True})
-                zugs = [t for t in existing["t"] if t in ['+zugzwang', '-zugzwang']] if existing else []
-                new_tags = [f"+{t}" for t in tags] + zugs
-                if not existing or set(new_tags) != set(existing["t"]):
-                    updated += 1
-                    round_coll.update_one({
-                        "_id": round_id
-                    }, {
-                        "$set": {
-                            "p": id,
-                            "d": datetime.now(),
-                            "e": 100,
-                            "t": new_tags
-                        }
-                    }, upsert = True);
-                    play_coll.update_many({"_id":id},{"$set":{"dirty":True}})
+    def cruncher(thread_id: int, batches: Batches, report: Report):
+        for docs in batches:
+            results = []
+            for doc in docs:
+                try:
+                    if "previous" in doc:
+                        tags = cook.recook(read(doc), doc["previous"], doc["versions"])
+                    else:
+                        tags = cook.cook(read(doc))
+                    results.append((doc["_id"], tags, versions))
+                except Exception as e:
+                    # left untagged, so the next run tries it again
+                    logger.error(f'{doc["_id"]}: {e!r}')
+            report(len(docs), 0, None if args.dry else results)
         print(f'{thread_id}/{args.threads} done')
 
-    with Pool(processes=threads) as pool:
-        for i in range(int(args.threads)):
-            Process(target=cruncher, args=(i,)).start()
+    try:
+        distribute(pending, cruncher, threads, batch_size, shard, shards, backend.write)
+    finally:
+        backend.close()
@@ -1,35 +1,83 @@
 import chess
 import chess.engine
 import math
+from collections import OrderedDict
 from chess import Board, Move, Color
-from chess.engine import SimpleEngine, Score
+from chess.engine import SimpleEngine, Score, PovScore
+from typing import Tuple
 from model import Puzzle
 
 engine_limit = chess.engine.Limit(depth = 30, time = 10, nodes = 12_000_000)
+# first pass of the escalating mode
+shallow_limit = chess.engine.Limit(depth = 14, nodes = 300_000)
 
-def zugzwang(engine: SimpleEngine, puzzle: Puzzle) -> bool:
+# drop in winning chances when the defender has to move instead of passing
+zugzwang_threshold = 0.3
+# shallow gaps at least this far from the threshold are trusted
+escalate_margin = 0.15
+# positions with more pieces than this, pawn endgames aside, are not searched
+max_pieces = 16
+
+# scores by position and limit, shared by every puzzle the process tags
+score_cache: "OrderedDict[Tuple[str, int, bool, str], PovScore]" = OrderedDict()
+score_cache_size = 200_000
+
+def zugzwang(engine: SimpleEngine, puzzle: Puzzle, escalate: bool = False) -> bool:
+    """
+    Defender positions are first screened without the engine by
+    `may_be_zugzwang`. With `escalate`, the rest are searched at
+    `shallow_limit` and only a null move gap close to
+    `zugzwang_threshold` gets the full `engine_limit` search.
+    """
     for node in puzzle.mainline[1::2]:
         board = node.board()
         if board.is_check():
             continue
         if len(list(board.legal_moves)) > 15:
             continue
-
-        score = score_of(engine, board, not puzzle.pov)
+        if not may_be_zugzwang(board):
+            continue
 
         rev_board = node.board()
         rev_board.push(Move.null())
-        rev_score = score_of(engine, rev_board, not puzzle.pov)
 
-        if win_chances(score) < win_chances(rev_score) - 0.3:
+        if escalate:
+            gap = null_move_gap(engine, board, rev_board, not puzzle.pov, shallow_limit)
+            if abs(gap - zugzwang_threshold) > escalate_margin:
+                if gap > zugzwang_threshold:
+                    return True
+                continue
+
+        if null_move_gap(engine, board, rev_board, not puzzle.pov, engine_limit) > zugzwang_threshold:
             return True
 
     return False
 
-def score_of(engine: SimpleEngine, board: Board, pov: Color):
-    info = engine.analyse(board, limit = engine_limit)
+def may_be_zugzwang(board: Board) -> bool:
+    # pawn endgames are where zugzwang lives, crowded boards almost never have one
+    pawn_endgame = not (board.occupied & ~board.pawns & ~board.kings)
+    return pawn_endgame or chess.popcount(board.occupied) <= max_pieces
+
+def null_move_gap(engine: SimpleEngine, board: Board, rev_board: Board, pov: Color, limit: chess.engine.Limit) -> float:
+    score = score_of(engine, board, pov, limit)
+    rev_score = score_of(engine, rev_board, pov, limit)
+    return win_chances(rev_score) - win_chances(score)
+
+def score_of(engine: SimpleEngine, board: Board, pov: Color, limit: chess.engine.Limit = engine_limit):
+    # the epd drops the move history the engine is given, the 50-move and
+    # repetition state it scores draws by are part of the key
+    position = (board.epd(), board.halfmove_clock, board.is_repetition(2))
+    # a full search also answers a shallow one
+    for key in [(*position, repr(engine_limit)), (*position, repr(limit))]:
+        if key in score_cache:
+            score_cache.move_to_end(key)
+            return score_cache[key].pov(pov)
+    info = engine.analyse(board, limit = limit)
     if "nps" in info:
         print(f'knps: {int(info["nps"] / 1000)} kn: {int(info["nodes"] / 1000)} depth: {info["depth"]} time: {info["time"]}')
+    score_cache[(*position, repr(limit))] = info["score"]
+    if len(score_cache) > score_cache_size:
+        score_cache.popitem(last = False)
     return info["score"].pov(pov)
 
 def win_chances(score: Score) -> float:
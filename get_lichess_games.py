@@ -4,8 +4,26 @@ import json
 import argparse
 import sys
 import os
+from datetime import datetime
+from chesspuzzler.analysis.game_store import default_store
+from chesspuzzler.analysis.constants import Constant
+from chesspuzzler.analysis.http_client import lichess_session
+from chesspuzzler.analysis.file_util import GameDownloader
 """Download players N most current Lichess games.
 """
+
+# per player export progress, so an interrupted export resumes
+EXPORT_DIR = os.path.join(".", "data", "exports")
+# games written between two checkpoint saves
+CHECKPOINT_EVERY = 50
+# per player time of the newest synced game
+SYNC_DIR = os.path.join(".", "data", "sync")
+# a sync looks this far behind the newest game it has, for games that were
+# still being played then (only finished games are exported)
+SYNC_OVERLAP_MS = 6 * 60 * 60 * 1000
+# games fetched by the first sync of a player when -n is not given, rather than their whole history
+FIRST_SYNC_GAMES = 200
+
 def set_args():
     """Download Lichess games using command line arguments provided.
     """
@@ -26,18 +44,166 @@ def set_args():
         type=int,
         help="Number of games to be downloaded."
     )
+    parser.add_argument(
+        "--evals",
+        action="store_true",
+        help="Include server analysis evals, when the game has them."
+    )
+    parser.add_argument(
+        "--clocks",
+        action="store_true",
+        help="Include clock times."
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore an unfinished export of this player and start over."
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only fetch games newer than the last sync of each player and queue them for analysis. "
+             f"-n limits the first sync of a player (default {FIRST_SYNC_GAMES} games)."
+    )
+    parser.add_argument(
+        "--users",
+        type=str,
+        help="File with one Lichess username per line, for --sync."
+    )
+    parser.add_argument(
+        "--ids",
+        type=str,
+        help="File of Lichess game ids, one per line or comma separated, to download into the game store "
+             "in bulk. Needs no --username; --token_path is optional."
+    )
 
     args = parser.parse_args()
 
-    if not all([args.token_path, args.username, args.n]):
+    if args.ids:
+        if not os.path.isfile(args.ids):
+            parser.exit(1, f"\nGame id file '{args.ids}' not found.\n")
+    elif args.sync:
+        if not args.token_path or not (args.username or args.users):
+            parser.print_help()
+            parser.exit(1, "\n--sync needs --token_path and --username or --users.\n")
+    elif not all([args.token_path, args.username, args.n]):
         parser.print_help()
         parser.exit(1, "\nAdd all required command line arguments.\n")
 
     return args
 
+def checkpoint_path(username):
+    return os.path.join(EXPORT_DIR, f"{username.lower()}.json")
+
+def sync_path(username):
+    return os.path.join(SYNC_DIR, f"{username.lower()}.json")
+
+def load_state(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def save_state(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(path + ".tmp", path)
+
+def created_at_ms(game_info):
+    created = game_info.get("createdAt")
+    if isinstance(created, datetime):
+        return int(created.timestamp() * 1000)
+    return int(created)
+
+def sync_player(client, store, username, args):
+    """
+    Stores the games `username` finished since the last sync and queues
+    the ones not stored before for analysis. Returns how many were new.
+    """
+    path = sync_path(username)
+    state = load_state(path)
+    newest = state.get("since")
+    new_games = 0
+
+    games_iterator = client.games.export_by_player(
+        username,
+        since=newest - SYNC_OVERLAP_MS if newest else None,
+        max=None if newest else args.n or FIRST_SYNC_GAMES,
+        pgn_in_json=True,
+        evals=args.evals or None,
+        clocks=args.clocks or None
+    )
+
+    os.makedirs(os.path.dirname(Constant.ANALYSIS_QUEUE_PATH), exist_ok=True)
+    with open(Constant.ANALYSIS_QUEUE_PATH, "a") as queue:
+        for game_info in games_iterator:
+            fullid = game_info.get("fullId")
+            if fullid not in store:
+                store.put(fullid, game_info.get("pgn"))
+                queue.write(fullid + "\n")
+                queue.flush()
+                new_games += 1
+            created = created_at_ms(game_info)
+            if newest is None or created > newest:
+                newest = created
+                state["last_id"] = fullid
+
+    # only moved on once the whole delta is stored, a failed sync is simply redone
+    if newest is not None:
+        state["since"] = newest
+    state["synced_at"] = datetime.now().isoformat()
+    save_state(path, state)
+    return new_games
+
+def sync_games(client, args):
+    if args.users:
+        with open(args.users) as file:
+            usernames = [line.strip() for line in file if line.strip()]
+    else:
+        usernames = [args.username]
+
+    store = default_store()
+    total = 0
+    for username in usernames:
+        try:
+            new_games = sync_player(client, store, username, args)
+            total += new_games
+            print(f"{username}: {new_games} new games")
+        except berserk.exceptions.BerserkError as e:
+            print(f"Error syncing {username}: {e}", file=sys.stderr)
+    print(f"{total} new games queued for analysis in '{Constant.ANALYSIS_QUEUE_PATH}'")
+
+def read_game_ids(path):
+    with open(path) as file:
+        return [game_id for line in file for game_id in line.replace(",", " ").split()]
+
+def download_by_ids(args, token):
+    """Stores the games listed in `args.ids`, requesting them in batches."""
+    game_ids = read_game_ids(args.ids)
+    download = GameDownloader()
+    if token:
+        download.session.headers.update({"Authorization": f"Bearer {token}"})
+    failures = download.get_games_via_gameids(game_ids)
+    for game_id, reason in failures.items():
+        print(f"Could not download {game_id}: {reason}", file=sys.stderr)
+    print(f"{len(set(game_ids)) - len(failures)} games downloaded and saved in the '{default_store().root}' game store")
+    print("HTTP:", download.session.metrics.summary())
+
 def download_games():
     args = set_args()
 
+    if args.ids:
+        token = None
+        if args.token_path:
+            if not os.path.isfile(args.token_path):
+                print("Token file not found. Please provide a valid path.", file=sys.stderr)
+                return
+            with open(args.token_path) as file:
+                token = json.load(file).get("LICHESS_API_TOKEN")
+        download_by_ids(args, token)
+        return
+
     if not os.path.isfile(args.token_path):
         print("Token file not found. Please provide a valid path.",
               file=sys.stderr)
@@ -46,31 +212,54 @@ def download_games():
     with open(args.token_path) as file:
         token = json.load(file)
 
-    session = berserk.TokenSession(token.get("LICHESS_API_TOKEN"))
+    session = lichess_session(token.get("LICHESS_API_TOKEN"))
     client = berserk.Client(session)
 
+    if args.sync:
+        sync_games(client, args)
+        print("HTTP:", session.metrics.summary())
+        return
+
+    # games arrive newest first: `until` is just before the last one written
+    checkpoint = load_state(checkpoint_path(args.username))
+    resuming = False
+    if args.restart or checkpoint.get("done") or checkpoint.get("n") != args.n:
+        checkpoint = {"n": args.n, "written": 0, "until": None, "last_id": None, "done": False}
+    elif checkpoint["written"]:
+        resuming = True
+        print(f"Resuming export after {checkpoint['written']} games, last one {checkpoint['last_id']}")
+
+    store = default_store()
     try:
         games_iterator = client.games.export_by_player(
             args.username,
-            max=args.n,
-            pgn_in_json=True
+            max=args.n - checkpoint["written"],
+            until=checkpoint["until"],
+            pgn_in_json=True,
+            evals=args.evals or None,
+            clocks=args.clocks or None
         )
 
-        games_list = list(games_iterator)
-
-        # Create a directory to store the downloaded games if it doesn't exist
-        os.makedirs("./data", exist_ok=True)
-        os.makedirs("./data/game_data", exist_ok=True)
-
-        for game_info in games_list:
+        for game_info in games_iterator:
             fullid = game_info.get("fullId")
-            filename = f"lichess_{fullid}.pgn"
-            filepath = os.path.join("./data/game_data", filename)
-            with open(filepath, "w") as file:
-                file.write(game_info.get("pgn"))
-        print(f"{args.n} games downloded and saved in the './data/game_data' directory")
+            # up to CHECKPOINT_EVERY games were stored after the checkpoint being resumed from,
+            # they are fetched again but not stored twice
+            if not (resuming and fullid in store):
+                store.put(fullid, game_info.get("pgn"))
+            checkpoint["written"] += 1
+            checkpoint["until"] = created_at_ms(game_info) - 1
+            checkpoint["last_id"] = fullid
+            if checkpoint["written"] % CHECKPOINT_EVERY == 0:
+                save_state(checkpoint_path(args.username), checkpoint)
+
+        checkpoint["done"] = True
+        print(f"{checkpoint['written']} games downloded and saved in the '{store.root}' game store")
     except berserk.exceptions.BerserkError as e:
         print(f"Error downloading files: {e}", file=sys.stderr)
+        print(f"{checkpoint['written']} games saved, run again to resume", file=sys.stderr)
+    finally:
+        save_state(checkpoint_path(args.username), checkpoint)
+        print("HTTP:", session.metrics.summary())
 
 if __name__ == "__main__":
     download_games()
\ No newline at end of file
@@ -4,49 +4,188 @@ Creates game analysis, puzzles, and puzzle tags.
 """
 version = 0.2
 
+import os
 import sys
 import argparse
+import multiprocessing
 from chess.engine import SimpleEngine
 from chesspuzzler.analysis.constants import Constant
 from chesspuzzler.analysis.file_util import GameDownloader
 from chesspuzzler.analysis.chess_analysis import GameAnalysis
+from chesspuzzler.analysis.depth_upgrade import DepthUpgrade
+from chesspuzzler.analysis.analysis_dataset import AnalysisDataset, games_below_depth
+from chesspuzzler.analysis.pgn_export import AnnotatedExporter, STORE_TARGET
 from chesspuzzler.generator.generator import Generator
-from chesspuzzler.tagger.cook import cook
+from chesspuzzler.generator.ingest import GameFilter, stream_games
+from chesspuzzler.generator.dump_index import find_game
+from chesspuzzler.tagger.cook import cook_many
 
 
 def parse_arguments():
     """Parse command-line arguments."""
     parser = argparse.ArgumentParser(description='Chess puzzle generator')
-    parser.add_argument('game_id', metavar='GAME_ID', type=str, help='ID of the game to analyze')
-    return parser.parse_args()
+    parser.add_argument('game_id', metavar='GAME_ID', type=str, nargs='?', help='ID of the game to analyze')
+    parser.add_argument('--pgn', type=str, help='Multi-game PGN file (.pgn, .pgn.bz2 or .pgn.zst) to generate puzzles from, using its evals')
+    parser.add_argument('--min_tier', type=int, default=0, help='Skip --pgn games below this time control / rating tier')
+    parser.add_argument('--workers', type=int, default=1, help='Processes parsing the --pgn file')
+    parser.add_argument('--queue', action='store_true', help='Analyze the games queued by get_lichess_games.py --sync')
+    parser.add_argument('--output', choices=['csv', 'parquet', 'both'], default=Constant.ANALYSIS_OUTPUT, help='Write analysis reports as CSV files, into the Parquet analysis dataset, or both')
+    parser.add_argument('--reuse_evals', type=int, nargs='?', const=Constant.SCAN_ENGINE_DEPTH, metavar='DEPTH', help='Trust evals already in the game at or above DEPTH (default: the scan depth) and only search the other plies')
+    parser.add_argument('--upgrade', type=int, metavar='DEPTH', help='Re-analyze GAME_ID, or every game of the analysis dataset, searching only plies analysed below DEPTH; the dataset is always updated')
+    parser.add_argument('--upgrade_budget', type=int, metavar='N', help='Re-search at most N plies per game with --upgrade')
+    parser.add_argument('--near_threshold', action='store_true', help='With --upgrade_budget, re-search the plies closest to changing judgement first')
+    parser.add_argument('--annotate', type=str, nargs='?', const=STORE_TARGET, metavar='PATH', help='Export analysed games with evals, NAGs and best moves to the PGN file PATH, or into the game store')
+    parser.add_argument('--dumps', type=str, nargs='*', default=[Constant.PGN_DUMP_DIR], help='Uncompressed PGN dumps, or directories of them, to look GAME_ID up in before downloading it')
+    args = parser.parse_args()
+    if not args.game_id and not args.pgn and not args.queue and args.upgrade is None:
+        parser.error('a GAME_ID, --pgn, --queue or --upgrade is required')
+    return args
 
-def main():
-    """Entry point of puzzle generator."""
-    args = parse_arguments()
+def print_puzzles(puzzles, pool=None):
+    print("Number of puzzles generated:", len(puzzles))
+    if puzzles:
+        print("Creating puzzle tags...")
+        for puzzle, tags in zip(puzzles, cook_many(puzzles, pool=pool)):
+            print("Puzzle:", puzzle.node.board().fen())
+            print("Puzzle Solution:", " ".join([move.uci() for move in puzzle.moves]))
+            print(puzzle)
+            print(puzzle.__dict__)
+            print("Puzzle Tags:", tags)
+
+def generate_from_pgn(path, min_tier, workers):
+    """Generate puzzles from every game of a PGN dump that carries evals."""
+    # the parsing and tagging pools are forked before the engine process and its thread exist
+    parse_pool = multiprocessing.Pool(workers) if workers > 1 else None
+    pool = multiprocessing.Pool()
+    try:
+        engine = SimpleEngine.popen_uci(Constant.ENGINE_PATH)
+        generator = Generator(engine)
+        try:
+            for game, tier in stream_games(path, GameFilter(min_tier=min_tier), workers, pool=parse_pool):
+                print_puzzles(generator.analyze_game(game, tier), pool)
+        finally:
+            engine.close()
+    finally:
+        for running in (parse_pool, pool):
+            if running is not None:
+                running.close()
+                running.join()
+
+def analyze_game(game, output=Constant.ANALYSIS_OUTPUT, reuse_depth=None, exporter=None, dataset=None):
+    """Analyze a game, then generate and tag its puzzles."""
+    print(game)
+    analyzer = GameAnalysis(game, output, reuse_depth, annotate=exporter is not None, dataset=dataset)
+    node = analyzer.game_analysis()
+    if exporter:
+        exporter.add(node)
+    engine = SimpleEngine.popen_uci(Constant.ENGINE_PATH)
+    puzzles = Generator(engine).analyze_game(node, 3)
+    # closed first, a pool must not fork with the engine alive
+    engine.close()
+    print_puzzles(puzzles)
+
+def upgrade_game(game, depth, budget=None, near_threshold=False, output=Constant.ANALYSIS_OUTPUT, exporter=None, dataset=None):
+    """Re-analyze a game at `depth`, searching only the plies analysed shallower."""
+    # an exporter into the store puts the upgraded game there already
+    store_game = exporter is None or exporter.target != STORE_TARGET
+    upgrade = DepthUpgrade(game, depth, output, budget, near_threshold, annotate=exporter is not None, store_game=store_game, dataset=dataset)
+    game = upgrade.game_analysis()
+    if exporter:
+        exporter.add(game)
+
+def upgrade_games(game_ids, depth, budget=None, near_threshold=False, output=Constant.ANALYSIS_OUTPUT, exporter=None):
+    """Re-analyze stored games at `depth`, searching only the plies analysed shallower."""
+    download = GameDownloader()
+    # one dataset for the run, so the games' rows are written a batch at a time
+    with AnalysisDataset() as dataset:
+        for game_id in game_ids:
+            game = download.load_pgn_game(game_id)
+            if not game:
+                print(f"Game {game_id} is not stored, skipping")
+                continue
+            upgrade_game(game, depth, budget, near_threshold, output, exporter, dataset)
+    dataset.compact()
+
+def mark_done(game_ids):
+    # both files are only appended to, so a sync can run meanwhile
+    with open(Constant.ANALYSIS_DONE_PATH, "a") as file:
+        file.writelines(game_id + "\n" for game_id in game_ids)
+
+def analyze_queue(output=Constant.ANALYSIS_OUTPUT, reuse_depth=None, exporter=None):
+    """Analyze queued games that are not done yet, marking them done once their reports are written."""
+    if not os.path.isfile(Constant.ANALYSIS_QUEUE_PATH):
+        print("No games queued for analysis")
+        return
+    done = set()
+    if os.path.isfile(Constant.ANALYSIS_DONE_PATH):
+        with open(Constant.ANALYSIS_DONE_PATH) as file:
+            done = {line.strip() for line in file}
+    with open(Constant.ANALYSIS_QUEUE_PATH) as file:
+        queued = [line.strip() for line in file if line.strip() and line.strip() not in done]
+
+    print("Games queued for analysis:", len(queued))
+    download = GameDownloader()
+    finished = []
+    with AnalysisDataset() as dataset:
+        try:
+            for game_id in dict.fromkeys(queued):
+                game = download.load_pgn_game(game_id)
+                if not game:
+                    # left queued, a later run picks it up once the game is stored
+                    print(f"Warning: queued game {game_id} is not stored, leaving it queued", file=sys.stderr)
+                    continue
+                analyze_game(game, output, reuse_depth, exporter, dataset)
+                finished.append(game_id)
+                # buffered rows would be lost in a crash, games are marked done once written
+                if not dataset.pending_rows:
+                    mark_done(finished)
+                    finished = []
+        finally:
+            # games analysed before an interruption are written and marked done
+            dataset.flush()
+            mark_done(finished)
+    dataset.compact()
+
+def run(args, exporter=None):
+    """Runs the mode selected on the command line."""
+    if args.pgn:
+        generate_from_pgn(args.pgn, args.min_tier, args.workers)
+        return
+    if args.queue:
+        analyze_queue(args.output, args.reuse_evals, exporter)
+        return
+    if args.upgrade is not None and not args.game_id:
+        game_ids = games_below_depth(args.upgrade)
+        print("Games analysed below depth {}: {}".format(args.upgrade, len(game_ids)))
+        upgrade_games(game_ids, args.upgrade, args.upgrade_budget, args.near_threshold, args.output, exporter)
+        return
     game_id = args.game_id
 
     download = GameDownloader()
     game = download.load_pgn_game(game_id)
 
+    if not game:
+        game = find_game(game_id, args.dumps)
+
     if not game:
         download.get_game_via_gameid(game_id)
         game = download.load_pgn_game(download.game_id)
 
-    print(game)
-    analyzer = GameAnalysis(game)
-    node = analyzer.game_analysis()
-    engine = SimpleEngine.popen_uci(Constant.ENGINE_PATH)
-    puzzles = Generator(engine).analyze_game(node, 3)
-    print("Number of puzzles generated:", len(puzzles))
-    if puzzles:
-        for puzzle in puzzles:
-            print("Puzzle:", puzzle.node.board().fen())
-            print("Puzzle Solution:", " ".join([move.uci() for move in puzzle.moves]))
-            print(puzzle)
-            print(puzzle.__dict__)
-            print("Creating puzzle tags...")
-            print("Puzzle Tags:", cook(puzzle))
-    engine.close()
+    if args.upgrade is not None:
+        upgrade_game(game, args.upgrade, args.upgrade_budget, args.near_threshold, args.output, exporter)
+    else:
+        analyze_game(game, args.output, args.reuse_evals, exporter)
+
+def main():
+    """Entry point of puzzle generator."""
+    args = parse_arguments()
+    exporter = AnnotatedExporter(args.annotate) if args.annotate else None
+    try:
+        run(args, exporter)
+    finally:
+        # games analysed so far are exported even when interrupted
+        if exporter:
+            exporter.close()
 
 if __name__ == "__main__":
     try: